@@ -0,0 +1,780 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+import msgspec
+import helper_functions as helpers
+import ranking
+import scoring
+import track_codec
+import feature_index
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [------------------------FIXTURE SPOTIFY------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Recorded Spotify API responses replayed by FixtureSpotify. Re-record them with record_fixtures
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures', 'spotify_responses.json')
+
+# Prefix of the track and artist IDs made up by FixtureSpotify. The rest of the ID is the track or artist number
+FIXTURE_ID_PREFIX = 'bench'
+
+
+
+
+class RecordingSpotify:
+    '''
+    Wraps a Spotipy object and keeps every response it returns, by method name, in the format FixtureSpotify
+    replays.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+    '''
+
+    def __init__(self, sp):
+        self._sp = sp
+        self.responses = {}
+
+    def __getattr__(self, name):
+        method = getattr(self._sp, name)
+
+        def recorded_call(*args, **kwargs):
+            response = method(*args, **kwargs)
+            self.responses.setdefault(name, []).append(response)
+            return response
+        return recorded_call
+
+
+
+
+def record_fixtures(sp, path=FIXTURES_PATH):
+    '''
+    Records one response from each Spotify API endpoint the helpers use, for FixtureSpotify to replay. Needs
+    a Spotipy object authorized for the user-top-read scope, e.g., from get_spotify() in a Flask shell.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        path: The fixtures file to write.
+
+    Returns:
+        None
+    '''
+
+    recording_sp = RecordingSpotify(sp)
+    top_tracks = recording_sp.current_user_top_tracks(limit=50, time_range='long_term', offset=0)
+    track_ids = [track['id'] for track in top_tracks['items']]
+    artist_uris = list(dict.fromkeys(
+        artist['uri'] for track in top_tracks['items'] for artist in track['artists']
+    ))
+    recording_sp.recommendations(seed_tracks=track_ids[:5], limit=5)
+    recording_sp.tracks(track_ids[:50])
+    recording_sp.artists(artist_uris[:50])
+    recording_sp.audio_features(tracks=track_ids[:100])
+
+    with open(path, 'w') as fixtures_file:
+        json.dump(recording_sp.responses, fixtures_file, indent=1)
+
+
+
+
+class FixtureSpotify:
+    '''
+    Stand-in for the Spotipy object that replays recorded Spotify API responses instead of calling the 
+    Spotify API, so the helper functions can be timed offline. Any number of tracks can be requested: each 
+    made-up track ID is answered with a recorded track (or artist, or audio features record) picked by its 
+    number, with the IDs and URIs rewritten and the audio features slightly varied so tracks don't tie.
+
+    Every call is counted in calls (by method name), with the number of IDs it carried in ids_requested, and
+    can be slowed down by latency seconds to stand in for the network.
+
+    Args:
+        fixtures: The recorded responses, as loaded by load_fixtures. Defaults to FIXTURES_PATH.
+        top_tracks: The number of top tracks the made-up user has.
+        artists: The number of different artists the made-up tracks are spread over.
+        latency: Seconds each call waits before answering.
+    '''
+
+    def __init__(self, fixtures=None, top_tracks=500, artists=2000, latency=0.0):
+        fixtures = fixtures if fixtures != None else load_fixtures()
+        self.top_tracks = top_tracks
+        self.artist_count = artists
+        self.latency = latency
+        self.calls = {}
+        self.ids_requested = {}
+        self._lock = threading.Lock()
+
+        # Every distinct recorded track, artist and audio features record is a template for made-up ones
+        track_templates = {}
+        for response in fixtures.get('current_user_top_tracks', []):
+            for track in response['items']:
+                track_templates[track['id']] = track
+        for response in fixtures.get('tracks', []) + fixtures.get('recommendations', []):
+            for track in response['tracks']:
+                if track != None:
+                    track_templates[track['id']] = track
+        self.track_templates = list(track_templates.values())
+        self.artist_templates = [
+            artist for response in fixtures.get('artists', []) for artist in response['artists'] if artist != None
+        ]
+        self.audio_features_templates = [
+            track_audio for response in fixtures.get('audio_features', []) for track_audio in response
+        ]
+
+    def _count(self, name, ids=0):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.ids_requested[name] = self.ids_requested.get(name, 0) + ids
+        if self.latency:
+            time.sleep(self.latency)
+
+    def api_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _number(self, spotify_id):
+        spotify_id = spotify_id.rsplit(':', 1)[-1]
+        if spotify_id.startswith(FIXTURE_ID_PREFIX) and spotify_id[len(FIXTURE_ID_PREFIX):].isdigit():
+            return int(spotify_id[len(FIXTURE_ID_PREFIX):])
+
+        # IDs from elsewhere (e.g., make_track_list) still get a stable number
+        return zlib.crc32(spotify_id.encode())
+
+    def _track(self, number):
+        template = self.track_templates[number % len(self.track_templates)]
+        track_id = f"{FIXTURE_ID_PREFIX}{number:017d}"
+        artists = []
+        for position, artist in enumerate(template['artists']):
+            artist_number = (number * 7 + position * 13) % self.artist_count
+            artist_id = f"{FIXTURE_ID_PREFIX}{artist_number:017d}"
+            artists.append(dict(artist, id=artist_id, uri=f"spotify:artist:{artist_id}"))
+        return dict(template, id=track_id, uri=f"spotify:track:{track_id}", artists=artists)
+
+    def current_user_top_tracks(self, limit=20, time_range='medium_term', offset=0):
+        self._count('current_user_top_tracks')
+        return {'items': [self._track(number) for number in range(offset, min(offset + limit, self.top_tracks))]}
+
+    def recommendations(self, seed_tracks=None, limit=20):
+        self._count('recommendations', len(seed_tracks))
+
+        # Recommend tracks outside the user's top tracks, picked by the seeds so the same seeds give the same tracks
+        seed = sum(self._number(track_id) for track_id in seed_tracks)
+        return {'tracks': [
+            self._track(self.top_tracks + (seed * 31 + position) % (self.top_tracks * 10)) for position in range(limit)
+        ]}
+
+    def tracks(self, tracks):
+        self._count('tracks', len(tracks))
+        return {'tracks': [self._track(self._number(track_id)) for track_id in tracks]}
+
+    def track(self, track_id):
+        self._count('track', 1)
+        return self._track(self._number(track_id))
+
+    def artists(self, artists):
+        self._count('artists', len(artists))
+        artists_list = []
+        for artist_uri in artists:
+            number = self._number(artist_uri)
+            artist_id = f"{FIXTURE_ID_PREFIX}{number:017d}"
+            template = self.artist_templates[number % len(self.artist_templates)]
+            artists_list.append(dict(template, id=artist_id, uri=f"spotify:artist:{artist_id}"))
+        return {'artists': artists_list}
+
+    def audio_features(self, tracks=None):
+        self._count('audio_features', len(tracks))
+        audio_features_list = []
+        for track_id in tracks:
+            number = self._number(track_id)
+            template = self.audio_features_templates[number % len(self.audio_features_templates)]
+            if template == None:
+                audio_features_list.append(None)
+                continue
+
+            rng = random.Random(number)
+            track_audio = dict(template, id=track_id.rsplit(':', 1)[-1])
+            for feature_name in helpers.AUDIO_FEATURES:
+                if track_audio.get(feature_name) != None:
+                    track_audio[feature_name] = min(max(track_audio[feature_name] + rng.uniform(-0.1, 0.1), 0.0), 1.0)
+            audio_features_list.append(track_audio)
+        return audio_features_list
+
+
+
+
+def load_fixtures(path=FIXTURES_PATH):
+    '''
+    Loads recorded Spotify API responses.
+
+    Args:
+        path: The fixtures file, as written by record_fixtures.
+
+    Returns:
+        A dictionary of Spotipy method name to a list of its recorded responses.
+    '''
+
+    with open(path) as fixtures_file:
+        return json.load(fixtures_file)
+
+
+
+
+def make_track_list(size):
+    '''
+    Builds a track_list of generated track objects in the same format as get_top_tracks.
+
+    Args:
+        size: The number of track objects to build.
+
+    Returns:
+        A list of track objects.
+    '''
+
+    track_list = []
+    for i in range(size):
+        track_object = {
+            'track_id': f"track{i}",
+            'track_uri': f"spotify:track:track{i}",
+            'artists': [f"Artist {i % 300}"],
+            'artist_uris': [f"spotify:artist:artist{i % 300}"],
+            'track_name': f"Track {i}",
+            'album_name': f"Album {i % 1000}",
+            'album_art': f"https://i.scdn.co/image/album{i % 1000}",
+            'genres': [f"genre {(i * 7 + n) % 400}" for n in range(i % 4)],
+            'score': 100.00,
+            'missing_audio_features': False
+        }
+        # The API returns audio features rounded to 3 significant digits, e.g., 0.735 or 2.46e-05
+        rng = random.Random(i)
+        for feature_name in helpers.AUDIO_FEATURES:
+            track_object[feature_name] = float(f"{rng.random():.3g}")
+        track_list.append(track_object)
+
+    return track_list
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [--------------------------BENCHMARKS---------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+def time_call(function, *args, repeat=3):
+    '''
+    Times a function call, returning the best of several runs.
+
+    Args:
+        function: The function to time.
+        *args: Arguments passed to function on each run.
+        repeat: The number of runs.
+
+    Returns:
+        The fastest run time in seconds.
+    '''
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+
+
+
+def bench_get_audio_features(sizes=(500, 1000, 2500, 5000, 10000)):
+    '''
+    Times get_audio_features across track_list sizes. Time per track should stay flat as the size grows.
+
+    Args:
+        sizes: The track_list sizes to time.
+
+    Returns:
+        None
+    '''
+
+    sp = FixtureSpotify()
+    print("get_audio_features")
+    for size in sizes:
+        track_list = make_track_list(size)
+        elapsed = time_call(lambda: helpers.get_audio_features(track_list, sp, cache=None))
+        print(f"  {size:>7} tracks  {elapsed * 1000:9.2f} ms  {elapsed / size * 1e6:7.2f} us/track")
+
+
+
+
+def bench_score_components(sizes=(500, 5000, 10000, 100000), selected=40):
+    '''
+    Times the scoring path of playlist_page across track_list sizes: update_score_components computing the
+    genre and audio features deduction vectors, then apply_score_components setting the final scores.
+
+    Args:
+        sizes: The track_list sizes to time.
+        selected: The number of genres the user selects.
+
+    Returns:
+        None
+    '''
+
+    input_values = {feature_name: "50" for feature_name in helpers.AUDIO_FEATURES}
+    genre_input = [f"genre {n * 10}" for n in range(selected)]
+    print(f"update_score_components / apply_score_components (NumPy {'on' if scoring.np != None else 'off'})")
+    for size in sizes:
+        track_list = make_track_list(size)
+        update = lambda: helpers.update_score_components(
+            None, track_list, genre_input=genre_input, input_values=input_values
+        )
+        update_elapsed = time_call(update)
+        score_components = update()
+
+        # apply_score_components overwrites each score, so the repeats score an already scored copy; the work is
+        # the same
+        scored = [dict(track) for track in track_list]
+        apply_elapsed = time_call(helpers.apply_score_components, score_components, scored)
+        print(f"  {size:>7} tracks  {update_elapsed * 1000:9.2f} ms  (apply {apply_elapsed * 1000:9.2f} ms)")
+
+
+
+
+def bench_get_final_playlist(sizes=(500, 5000, 10000, 100000)):
+    '''
+    Times get_final_playlist across track_list sizes.
+
+    Args:
+        sizes: The track_list sizes to time.
+
+    Returns:
+        None
+    '''
+
+    sp = FixtureSpotify()
+    print("get_final_playlist")
+    for size in sizes:
+        track_list = make_track_list(size)
+        for i, track in enumerate(track_list):
+            track['score'] = random.Random(i).uniform(0, 100)
+        elapsed = time_call(helpers.get_final_playlist, track_list, sp)
+        print(f"  {size:>7} tracks  {elapsed * 1000:9.2f} ms")
+
+
+
+
+def bench_track_codec(sizes=(500, 5000)):
+    '''
+    Compares track_list in the session stored as track objects versus packed with track_codec. flask_session
+    decodes and encodes the whole session with MessagePack on every request, so each request type is timed with
+    that round trip: requests that save track_list (including packing), requests that load it (including 
+    unpacking) and every other request.
+
+    Args:
+        sizes: The track_list sizes to time.
+
+    Returns:
+        None
+    '''
+
+    encoder = msgspec.msgpack.Encoder()
+    decoder = msgspec.msgpack.Decoder()
+
+    def save_request(session_data, track_list, pack):
+        session = decoder.decode(session_data)
+        session['track_list'] = track_codec.pack_track_list(track_list) if pack else track_list
+        return encoder.encode(session)
+
+    def load_request(session_data):
+        session = decoder.decode(session_data)
+        track_codec.unpack_track_list(session['track_list'])
+        return encoder.encode(session)
+
+    def other_request(session_data):
+        return encoder.encode(decoder.decode(session_data))
+
+    print("track_list session payload and time per request (track objects / packed)")
+    for size in sizes:
+        track_list = make_track_list(size)
+        plain = encoder.encode({'track_list': track_list})
+        packed = encoder.encode({'track_list': track_codec.pack_track_list(track_list)})
+        assert track_codec.unpack_track_list(decoder.decode(packed)['track_list']) == track_list
+
+        timings = [
+            (
+                time_call(save_request, plain, track_list, False, repeat=20),
+                time_call(save_request, packed, track_list, True, repeat=20)
+            ),
+            (time_call(load_request, plain, repeat=20), time_call(load_request, packed, repeat=20)),
+            (time_call(other_request, plain, repeat=20), time_call(other_request, packed, repeat=20))
+        ]
+        print(
+            f"  {size:>7} tracks  {len(plain):>9} / {len(packed):>9} bytes ({len(plain) / len(packed):.1f}x)  "
+            + "  ".join(
+                f"{name} {plain_elapsed * 1000:6.2f} / {packed_elapsed * 1000:6.2f} ms"
+                for name, (plain_elapsed, packed_elapsed) in zip(('save', 'load', 'other'), timings)
+            )
+        )
+
+
+
+
+def bench_feature_index(sizes=(500, 10000, 100000), k=30):
+    '''
+    Compares finding the k tracks closest to a slider vector with a FeatureIndex query versus scoring every 
+    track, with and without a genre filter.
+
+    Args:
+        sizes: The track_list sizes to time.
+        k: The number of tracks to find.
+
+    Returns:
+        None
+    '''
+
+    rng = random.Random(0)
+    print("k closest tracks (FeatureIndex query / scoring every track)")
+    for size in sizes:
+        track_list = make_track_list(size)
+        input_values = {feature_name: rng.randint(0, 100) for feature_name in helpers.AUDIO_FEATURES}
+        build_elapsed = time_call(feature_index.FeatureIndex, track_list, repeat=1)
+        index = feature_index.FeatureIndex(track_list)
+
+        def score_every_track(genre_input):
+            scored = [dict(track) for track in track_list]
+            if genre_input != None:
+                scored = [track for track in scored if set(track['genres']) & set(genre_input)]
+            return scoring.select_top_tracks(helpers.feature_score_deduction(input_values, scored), k)
+
+        for genre_input in (None, ['genre 7']):
+            query_elapsed = time_call(index.query, input_values, k, genre_input)
+            linear_elapsed = time_call(score_every_track, genre_input)
+            print(
+                f"  {size:>7} tracks  {'genre filter' if genre_input else 'no filter':>12}"
+                f"  {query_elapsed * 1000:9.2f} / {linear_elapsed * 1000:9.2f} ms  (build {build_elapsed:.2f} s)"
+            )
+
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [------------------------BENCHMARK SUITE------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Track pool sizes the suite runs each helper at
+SUITE_SIZES = (500, 5000, 20000, 100000)
+
+# Relative increase in wall time or peak memory that compare_results reports as a regression
+REGRESSION_THRESHOLD = 0.2
+
+# Wall time changes smaller than this many milliseconds are treated as noise by compare_results
+REGRESSION_NOISE_MS = 1.0
+
+
+
+
+def use_fresh_catalog():
+    '''
+    Points the helpers' catalog at a new, empty in-memory database, so every run starts cold: its API calls 
+    don't depend on earlier runs, and nothing is written to the catalog file.
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+
+    helpers.CATALOG.close()
+    helpers.CATALOG.path = ':memory:'
+
+
+
+
+def fixture_track_list(sp, size):
+    '''
+    Builds a track_list of size top tracks from FixtureSpotify's recorded tracks, without counting any calls.
+
+    Args:
+        sp: The FixtureSpotify object.
+        size: The number of track objects to build.
+
+    Returns:
+        A list of track objects, before genres and audio features are set.
+    '''
+
+    return [helpers.create_track_object(sp._track(number)) for number in range(size)]
+
+
+
+
+def measure(run, setup, sp, repeat=3):
+    '''
+    Measures one helper run: the fastest wall time of several runs, the Spotify API calls made by one run, 
+    and the peak memory allocated by one run (measured in a separate run, since tracing memory slows Python
+    down). setup is called before every run and is not measured.
+
+    Args:
+        run: The function to measure. It is called with the values returned by setup.
+        setup: A function that prepares the inputs of one run and returns them as a tuple.
+        sp: The FixtureSpotify object run uses.
+        repeat: The number of timed runs.
+
+    Returns:
+        A dictionary of wall_ms, api_calls and peak_kib.
+    '''
+
+    best = None
+    api_calls = None
+    for i in range(repeat):
+        arguments = setup()
+        calls_before = sp.api_calls()
+        start = time.perf_counter()
+        run(*arguments)
+        elapsed = time.perf_counter() - start
+        if api_calls == None:
+            api_calls = sp.api_calls() - calls_before
+        if best == None or elapsed < best:
+            best = elapsed
+
+    arguments = setup()
+    tracemalloc.start()
+    run(*arguments)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'wall_ms': round(best * 1000, 3), 'api_calls': api_calls, 'peak_kib': round(peak / 1024, 1)}
+
+
+
+
+def run_suite(sizes=SUITE_SIZES, latency=0.0, repeat=3):
+    '''
+    Runs each helper against FixtureSpotify at each track pool size, starting cold every time.
+
+    Args:
+        sizes: The track pool sizes.
+        latency: Seconds each Spotify API call waits, standing in for the network.
+        repeat: The number of timed runs of each helper at each size.
+
+    Returns:
+        A list of results, each a dictionary of benchmark, size, wall_ms, api_calls and peak_kib.
+    '''
+
+    input_values = {feature_name: "50" for feature_name in helpers.AUDIO_FEATURES}
+    slider_values = {feature_name: 50.0 for feature_name in helpers.AUDIO_FEATURES}
+    genre_input = ['indie pop', 'rock', 'vocal jazz', 'french house']
+    results = []
+
+    def score_track_list(track_list):
+
+        # The same path as playlist_page: deduction vectors from the user's inputs, then the final scores
+        score_components = helpers.update_score_components(
+            None, track_list, genre_input=genre_input, input_values=input_values
+        )
+        return helpers.apply_score_components(score_components, track_list)
+
+    for size in sizes:
+        sp = FixtureSpotify(top_tracks=size, latency=latency)
+        top_tracks = fixture_track_list(sp, size)
+        enriched = make_track_list(size)
+
+        def fresh(track_list):
+            def setup():
+                use_fresh_catalog()
+                return ([dict(track) for track in track_list],)
+            return setup
+
+        def playlist_setup():
+            use_fresh_catalog()
+            track_list = []
+            for i, track in enumerate(enriched):
+
+                # Every tenth track is missing its album art, so get_album_art has something to fetch
+                track_list.append(dict(
+                    track, score=random.Random(i).uniform(0, 100), album_art=None if i % 10 == 0 else track['album_art']
+                ))
+            return (track_list,)
+
+        def ranking_setup():
+
+            # The ranking is built once per track_list (see features_rank_page); each slider change only ranks
+            use_fresh_catalog()
+            return (ranking.PreparedRanking(enriched),)
+
+        cases = [
+            ('get_top_tracks', lambda: helpers.get_all_top_tracks(sp, total=size), lambda: use_fresh_catalog() or ()),
+            ('get_new_tracks', lambda track_list: helpers.get_new_tracks(track_list, sp), fresh(top_tracks)),
+            ('set_artist_genres', lambda track_list: helpers.set_artist_genres(track_list, sp), fresh(top_tracks)),
+            ('get_audio_features', lambda track_list: helpers.get_audio_features(track_list, sp), fresh(top_tracks)),
+            ('score_components', score_track_list, fresh(enriched)),
+            ('PreparedRanking', lambda track_list: ranking.PreparedRanking(track_list), fresh(enriched)),
+            ('PreparedRanking.rank', lambda prepared_ranking: prepared_ranking.rank(slider_values), ranking_setup),
+            ('get_final_playlist', lambda track_list: helpers.get_final_playlist(track_list, sp), playlist_setup)
+        ]
+        for name, run, setup in cases:
+            result = {'benchmark': name, 'size': size}
+            result.update(measure(run, setup, sp, repeat=repeat))
+            results.append(result)
+            print(format_result(result), flush=True)
+
+    use_fresh_catalog()
+    return results
+
+
+
+
+def format_result(result):
+    return (
+        f"{result['benchmark']:<24}{result['size']:>8}{result['wall_ms']:>12.2f}"
+        f"{result['api_calls']:>11}{result['peak_kib']:>12.1f}"
+    )
+
+
+
+
+def suite_metadata(latency):
+    '''
+    Describes what a suite run was measured on, so saved results can be matched to the commit they came from.
+
+    Args:
+        latency: The latency the suite was run with.
+
+    Returns:
+        A dictionary of commit, python, numpy and latency.
+    '''
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'numpy': scoring.np.__version__ if scoring.np != None else None,
+        'latency': latency
+    }
+
+
+
+
+def compare_results(baseline, results, threshold=REGRESSION_THRESHOLD):
+    '''
+    Compares suite results against a baseline saved from another commit. A benchmark regressed if it makes
+    more API calls, or its wall time or peak memory grew by more than threshold.
+
+    Args:
+        baseline: The saved results of the baseline run, as written by the suite's --save option.
+        results: The results of this run.
+        threshold: The relative increase reported as a regression.
+
+    Returns:
+        The number of regressions found.
+    '''
+
+    baseline_results = {(result['benchmark'], result['size']): result for result in baseline['results']}
+    regressions = 0
+    print(f"Compared with {baseline['metadata'].get('commit')} (wall ms / API calls / peak KiB)")
+    for result in results:
+        old = baseline_results.get((result['benchmark'], result['size']))
+        if old == None:
+            continue
+
+        problems = []
+        if result['api_calls'] > old['api_calls']:
+            problems.append("API calls")
+        if (result['wall_ms'] > old['wall_ms'] * (1 + threshold)
+                and result['wall_ms'] - old['wall_ms'] > REGRESSION_NOISE_MS):
+            problems.append("wall time")
+        if result['peak_kib'] > old['peak_kib'] * (1 + threshold):
+            problems.append("peak memory")
+        regressions += 1 if problems else 0
+
+        line = (
+            f"  {result['benchmark']:<24}{result['size']:>8}"
+            f"  {old['wall_ms']:>10.2f} -> {result['wall_ms']:<10.2f}"
+            f"  {old['api_calls']:>6} -> {result['api_calls']:<6}"
+            f"  {old['peak_kib']:>10.1f} -> {result['peak_kib']:<10.1f}"
+            f"  {'REGRESSION: ' + ', '.join(problems) if problems else ''}"
+        )
+        print(line.rstrip())
+
+    return regressions
+
+
+
+
+def run_micro_benchmarks():
+    bench_get_audio_features()
+    bench_score_components()
+    bench_get_final_playlist()
+    bench_track_codec()
+    bench_feature_index()
+
+
+
+
+# Run the benchmarks:
+#   python benchmark.py                 micro benchmarks, then the suite
+#   python benchmark.py micro           micro benchmarks only
+#   python benchmark.py suite --save results.json --compare baseline.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the helper functions.")
+    parser.add_argument('command', nargs='?', choices=['all', 'micro', 'suite'], default='all')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SUITE_SIZES), help="track pool sizes")
+    parser.add_argument('--latency', type=float, default=0.0, help="milliseconds added to every API call")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument('--save', help="file to save the suite results to, as JSON")
+    parser.add_argument('--compare', help="suite results saved from another commit to compare against")
+    arguments = parser.parse_args()
+
+    use_fresh_catalog()
+    if arguments.command in ('all', 'micro'):
+        run_micro_benchmarks()
+
+    if arguments.command in ('all', 'suite'):
+        latency = arguments.latency / 1000
+        print(f"{'benchmark':<24}{'size':>8}{'wall ms':>12}{'API calls':>11}{'peak KiB':>12}")
+        results = run_suite(sizes=arguments.sizes, latency=latency, repeat=arguments.repeat)
+
+        if arguments.save:
+            with open(arguments.save, 'w') as results_file:
+                json.dump({'metadata': suite_metadata(latency), 'results': results}, results_file, indent=1)
+
+        if arguments.compare:
+            with open(arguments.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+            if compare_results(baseline, results) > 0:
+                sys.exit(1)
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [----------------------------CACHES-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+class MemoryCache:
+    '''
+    An in-memory key/value cache with the same interface as catalog.CatalogCache. Entries expire after ttl 
+    seconds, and once the cache holds more than max_size entries the least recently used ones are evicted. Entries
+    are lost when the process exits and are not shared between processes.
+
+    Args:
+        ttl: The number of seconds an entry stays valid.
+        max_size: The most entries kept before the least recently used are evicted.
+    '''
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        '''
+        Looks up several keys at once. Keys that are missing or expired count as misses.
+
+        Args:
+            keys: A list of keys.
+
+        Returns:
+            A dictionary of key to cached value, for the keys that were found.
+        '''
+
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry == None:
+                    continue
+                value, expires_at = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+
+                # Move hits to the end so they are the last to be evicted
+                self._entries.move_to_end(key)
+                found[key] = value
+
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(set(keys)) - len(found)
+
+        return found
+
+    def set_many(self, values, ttl=None):
+        '''
+        Saves several values at once, then evicts the least recently used entries if the cache is over max_size.
+
+        Args:
+            values: A dictionary of key to value.
+            ttl: Optional number of seconds these entries stay valid, instead of the cache's ttl.
+
+        Returns:
+            None
+        '''
+
+        expires_at = time.time() + (self.ttl if ttl == None else ttl)
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        '''
+        Removes every entry from the cache.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            self._entries.clear()
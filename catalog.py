@@ -0,0 +1,627 @@
+import json
+import math
+import sqlite3
+import sys
+import threading
+import time
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [----------------------------CATALOG----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Most parameters sent in one SQLite query. Lookups with more keys are split into chunks
+QUERY_CHUNK_SIZE = 500
+
+# Seconds between updates of a record's last used time. A record read again sooner isn't rewritten, so busy 
+# records don't cost a write on every lookup
+LAST_USED_RESOLUTION = 60
+
+# A CatalogCache over max_size evicts down to this fraction of it, so it doesn't have to evict (and recount
+# its records) again on every write after reaching max_size
+EVICT_TO = 0.9
+
+# Kinds of records a CatalogCache can present: the table, key column and last used column of each, and the
+# condition a row has to meet to hold a record of that kind
+RECORD_KINDS = {
+    'artist_genres': ('artists', 'artist_uri', 'genres_last_used', 'genres IS NOT NULL'),
+    'audio_features': ('audio_features', 'track_id', 'last_used', '1')
+}
+
+
+
+
+class TrackCatalog:
+    '''
+    A local catalog of every track, artist and audio features record the helpers have seen, stored in SQLite
+    and shared by all users (and all processes using the same file). Tracks are upserted as they are
+    parsed, so later lookups of the same tracks can be hydrated from the catalog instead of Spotify. Artist
+    genres and audio features expire, like the caches they replace; expired rows are removed by compact().
+
+    Args:
+        path: The SQLite database file.
+        feature_names: The audio features stored per track, e.g., helper_functions.AUDIO_FEATURES.
+    '''
+
+    def __init__(self, path, feature_names):
+        self.path = path
+        self.feature_names = list(feature_names)
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+
+        # Connect the first time the catalog is used rather than at import time, so importing the helpers
+        # doesn't create the database file
+        if self._connection == None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+
+            # Write-ahead logging lets other processes read the catalog while one of them writes to it
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+
+            feature_columns = "".join(f"{feature_name} REAL, " for feature_name in self.feature_names)
+            self._connection.executescript(f'''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    track_id TEXT PRIMARY KEY,
+                    track_uri TEXT NOT NULL,
+                    track_name TEXT,
+                    album_name TEXT,
+                    album_art TEXT,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tracks_updated_at ON tracks (updated_at);
+
+                CREATE TABLE IF NOT EXISTS track_artists (
+                    track_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    artist_uri TEXT NOT NULL,
+                    PRIMARY KEY (track_id, position)
+                );
+                CREATE INDEX IF NOT EXISTS track_artists_artist_uri ON track_artists (artist_uri);
+
+                CREATE TABLE IF NOT EXISTS artists (
+                    artist_uri TEXT PRIMARY KEY,
+                    name TEXT,
+                    genres TEXT,
+                    genres_expires_at REAL,
+                    genres_last_used REAL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS artists_genres_expires_at ON artists (genres_expires_at);
+
+                CREATE TABLE IF NOT EXISTS audio_features (
+                    track_id TEXT PRIMARY KEY,
+                    {feature_columns}
+                    missing INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS audio_features_expires_at ON audio_features (expires_at);
+            ''')
+
+            # Catalogs created before records had a last used time get the column added. Their existing
+            # records count as least recently used
+            for table, _, last_used_column, _ in RECORD_KINDS.values():
+                columns = [row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")]
+                if last_used_column not in columns:
+                    self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {last_used_column} REAL")
+                self._connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_{last_used_column} ON {table} ({last_used_column})"
+                )
+            self._connection.commit()
+        return self._connection
+
+    def _select_chunks(self, query, keys, *parameters):
+
+        # SQLite limits the number of parameters in one query, so look the keys up in chunks. query has a
+        # {placeholders} field for the keys, followed by any other parameters
+        connection = self._connect()
+        rows = []
+        for offset in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = list(keys[offset:offset+QUERY_CHUNK_SIZE])
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(connection.execute(query.format(placeholders=placeholders), chunk + list(parameters)))
+        return rows
+
+    def _count_records(self, kind, keys):
+
+        # Called with the lock held. Counts how many of keys already hold a record of kind
+        table, key_column, _, condition = RECORD_KINDS[kind]
+        rows = self._select_chunks(
+            f"SELECT COUNT(*) FROM {table} WHERE {key_column} IN ({{placeholders}}) AND {condition}", keys
+        )
+        return sum(row[0] for row in rows)
+
+    def close(self):
+        '''
+        Closes the database connection. The catalog reconnects the next time it is used, e.g., after path is
+        changed.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            if self._connection != None:
+                self._connection.close()
+                self._connection = None
+
+    def upsert_tracks(self, track_list):
+        '''
+        Saves the details of every track in track_list, and the names of their artists, in one transaction.
+        Tracks already in the catalog are updated, keeping their album art if the new record has none.
+
+        Args:
+            track_list: A list of track objects, e.g., from create_track_object.
+
+        Returns:
+            None
+        '''
+
+        now = time.time()
+        track_rows = []
+        track_artist_rows = []
+        artist_rows = {}
+        for track in track_list:
+            track_rows.append((
+                track['track_id'], track['track_uri'], track['track_name'], track['album_name'],
+                track.get('album_art'), now
+            ))
+            for position, (artist_name, artist_uri) in enumerate(zip(track['artists'], track['artist_uris'])):
+                track_artist_rows.append((track['track_id'], position, artist_uri))
+                artist_rows[artist_uri] = (artist_uri, artist_name, now)
+
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT INTO tracks (track_id, track_uri, track_name, album_name, album_art, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (track_id) DO UPDATE SET "
+                "track_uri = excluded.track_uri, track_name = excluded.track_name, "
+                "album_name = excluded.album_name, album_art = COALESCE(excluded.album_art, tracks.album_art), "
+                "updated_at = excluded.updated_at",
+                track_rows
+            )
+
+            # Replace each track's artists, in case the track was saved with fewer artists before
+            connection.executemany(
+                "DELETE FROM track_artists WHERE track_id = ?", [(row[0],) for row in track_rows]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO track_artists (track_id, position, artist_uri) VALUES (?, ?, ?)",
+                track_artist_rows
+            )
+            connection.executemany(
+                "INSERT INTO artists (artist_uri, name, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (artist_uri) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at",
+                list(artist_rows.values())
+            )
+            connection.commit()
+
+    def get_tracks(self, track_ids):
+        '''
+        Looks up the details of several tracks at once.
+
+        Args:
+            track_ids: A list of track IDs.
+
+        Returns:
+            A dictionary of track_id to a record with the track_id, track_uri, artists, artist_uris,
+            track_name, album_name and album_art of the track, for the tracks that were found.
+        '''
+
+        with self._lock:
+            track_rows = self._select_chunks(
+                "SELECT track_id, track_uri, track_name, album_name, album_art FROM tracks "
+                "WHERE track_id IN ({placeholders})",
+                track_ids
+            )
+            artist_rows = self._select_chunks(
+                "SELECT track_artists.track_id, track_artists.artist_uri, artists.name FROM track_artists "
+                "JOIN artists ON artists.artist_uri = track_artists.artist_uri "
+                "WHERE track_artists.track_id IN ({placeholders}) "
+                "ORDER BY track_artists.track_id, track_artists.position",
+                [row[0] for row in track_rows]
+            )
+
+        records = {}
+        for track_id, track_uri, track_name, album_name, album_art in track_rows:
+            records[track_id] = {
+                'track_id': track_id,
+                'track_uri': track_uri,
+                'artists': [],
+                'artist_uris': [],
+                'track_name': track_name,
+                'album_name': album_name,
+                'album_art': album_art
+            }
+        for track_id, artist_uri, artist_name in artist_rows:
+            records[track_id]['artists'].append(artist_name)
+            records[track_id]['artist_uris'].append(artist_uri)
+
+        return records
+
+    def upsert_artist_genres(self, genres_by_uri, expires_at):
+        '''
+        Saves the genres of several artists in one transaction.
+
+        Args:
+            genres_by_uri: A dictionary of artist URI to that artist's list of genres.
+            expires_at: The time (as from time.time()) the genres stop being valid.
+
+        Returns:
+            The number of artists that had no genres saved before.
+        '''
+
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            existing = self._count_records('artist_genres', list(genres_by_uri))
+            connection.executemany(
+                "INSERT INTO artists (artist_uri, genres, genres_expires_at, genres_last_used, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (artist_uri) DO UPDATE SET genres = excluded.genres, "
+                "genres_expires_at = excluded.genres_expires_at, genres_last_used = excluded.genres_last_used, "
+                "updated_at = excluded.updated_at",
+                [
+                    (artist_uri, json.dumps(genres), expires_at, now, now)
+                    for artist_uri, genres in genres_by_uri.items()
+                ]
+            )
+            connection.commit()
+        return len(genres_by_uri) - existing
+
+    def get_artist_genres(self, artist_uris):
+        '''
+        Looks up the genres of several artists at once. Genres that have expired are treated as missing.
+
+        Args:
+            artist_uris: A list of artist URIs.
+
+        Returns:
+            A dictionary of artist URI to that artist's list of genres, for the artists that were found.
+        '''
+
+        with self._lock:
+            rows = self._select_chunks(
+                "SELECT artist_uri, genres FROM artists WHERE artist_uri IN ({placeholders}) "
+                "AND genres IS NOT NULL AND genres_expires_at > ?",
+                artist_uris, time.time()
+            )
+        return {artist_uri: json.loads(genres) for artist_uri, genres in rows}
+
+    def upsert_audio_features(self, features_by_id, expires_at):
+        '''
+        Saves the audio features of several tracks in one transaction. A None record means Spotify has no
+        audio features for the track.
+
+        Args:
+            features_by_id: A dictionary of track_id to its audio features record (as from sp.audio_features),
+                or None.
+            expires_at: The time (as from time.time()) the records stop being valid.
+
+        Returns:
+            The number of tracks that had no audio features record saved before.
+        '''
+
+        now = time.time()
+        rows = []
+        for track_id, track_audio in features_by_id.items():
+            if track_audio == None:
+                rows.append((track_id, *[None] * len(self.feature_names), 1, expires_at, now, now))
+            else:
+                values = [track_audio.get(feature_name) for feature_name in self.feature_names]
+                rows.append((track_id, *values, 0, expires_at, now, now))
+
+        columns = ", ".join(
+            ["track_id"] + self.feature_names + ["missing", "expires_at", "last_used", "updated_at"]
+        )
+        placeholders = ", ".join("?" * (len(self.feature_names) + 5))
+        with self._lock:
+            connection = self._connect()
+            existing = self._count_records('audio_features', list(features_by_id))
+            connection.executemany(
+                f"INSERT OR REPLACE INTO audio_features ({columns}) VALUES ({placeholders})", rows
+            )
+            connection.commit()
+        return len(features_by_id) - existing
+
+    def get_audio_features(self, track_ids):
+        '''
+        Looks up the audio features of several tracks at once. Records that have expired are treated as
+        missing.
+
+        Args:
+            track_ids: A list of track IDs.
+
+        Returns:
+            A dictionary of track_id to its audio features record, or to None if Spotify has no audio features
+            for the track, for the tracks that were found.
+        '''
+
+        columns = ", ".join(["track_id", "missing"] + self.feature_names)
+        with self._lock:
+            rows = self._select_chunks(
+                f"SELECT {columns} FROM audio_features WHERE track_id IN ({{placeholders}}) AND expires_at > ?",
+                track_ids, time.time()
+            )
+
+        found = {}
+        for track_id, missing, *values in rows:
+            if missing:
+                found[track_id] = None
+            else:
+                found[track_id] = dict(zip(self.feature_names, values), id=track_id)
+        return found
+
+    def bulk_insert(self, tracks=None, artist_genres=None, audio_features=None, ttl=None):
+        '''
+        Loads many records at once, e.g., to seed the catalog from an export. Each kind of record is saved
+        in a single transaction.
+
+        Args:
+            tracks: Optional list of track objects.
+            artist_genres: Optional dictionary of artist URI to that artist's list of genres.
+            audio_features: Optional dictionary of track_id to its audio features record.
+            ttl: Seconds the genres and audio features stay valid. Defaults to never expiring.
+
+        Returns:
+            None
+        '''
+
+        expires_at = float('inf') if ttl == None else time.time() + ttl
+        if tracks:
+            self.upsert_tracks(tracks)
+        if artist_genres:
+            self.upsert_artist_genres(artist_genres, expires_at)
+        if audio_features:
+            self.upsert_audio_features(audio_features, expires_at)
+
+    def mark_used(self, kind, keys):
+        '''
+        Records that several artist genres or audio features records were just read, so they are the last to
+        be evicted by evict_least_recently_used. Records marked in the last LAST_USED_RESOLUTION seconds aren't
+        rewritten.
+
+        Args:
+            kind: "artist_genres" or "audio_features".
+            keys: A list of the artist URIs or track IDs that were read.
+
+        Returns:
+            None
+        '''
+
+        table, key_column, last_used_column, _ = RECORD_KINDS[kind]
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            for offset in range(0, len(keys), QUERY_CHUNK_SIZE):
+                chunk = list(keys[offset:offset+QUERY_CHUNK_SIZE])
+                placeholders = ",".join("?" * len(chunk))
+                connection.execute(
+                    f"UPDATE {table} SET {last_used_column} = ? WHERE {key_column} IN ({placeholders}) "
+                    f"AND ({last_used_column} IS NULL OR {last_used_column} < ?)",
+                    [now] + chunk + [now - LAST_USED_RESOLUTION]
+                )
+            connection.commit()
+
+    def count(self, kind):
+        '''
+        Counts the artist genres or audio features records in the catalog, including expired ones that
+        compact() hasn't removed yet.
+
+        Args:
+            kind: "artist_genres" or "audio_features".
+
+        Returns:
+            The number of records.
+        '''
+
+        table, _, _, condition = RECORD_KINDS[kind]
+        with self._lock:
+            return self._connect().execute(f"SELECT COUNT(*) FROM {table} WHERE {condition}").fetchone()[0]
+
+    def evict_least_recently_used(self, kind, count):
+        '''
+        Removes the count artist genres or audio features records that were read (or saved) longest ago.
+        Artists themselves are kept (only their genres are removed), since tracks refer to them.
+
+        Args:
+            kind: "artist_genres" or "audio_features".
+            count: The number of records to remove.
+
+        Returns:
+            The number of records removed.
+        '''
+
+        table, key_column, last_used_column, condition = RECORD_KINDS[kind]
+        least_recently_used = (
+            f"SELECT {key_column} FROM {table} WHERE {condition} ORDER BY {last_used_column} LIMIT ?"
+        )
+        with self._lock:
+            connection = self._connect()
+            if kind == 'artist_genres':
+                removed = connection.execute(
+                    "UPDATE artists SET genres = NULL, genres_expires_at = NULL, genres_last_used = NULL "
+                    f"WHERE artist_uri IN ({least_recently_used})", (count,)
+                ).rowcount
+            else:
+                removed = connection.execute(
+                    f"DELETE FROM audio_features WHERE track_id IN ({least_recently_used})", (count,)
+                ).rowcount
+            connection.commit()
+        return removed
+
+    def clear(self, kind):
+        '''
+        Removes every artist genres or audio features record. Artists themselves are kept.
+
+        Args:
+            kind: "artist_genres" or "audio_features".
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            connection = self._connect()
+            if kind == 'artist_genres':
+                connection.execute(
+                    "UPDATE artists SET genres = NULL, genres_expires_at = NULL, genres_last_used = NULL"
+                )
+            else:
+                connection.execute("DELETE FROM audio_features")
+            connection.commit()
+
+    def counts(self):
+        '''
+        Counts the rows in each table of the catalog.
+
+        Args:
+            None
+
+        Returns:
+            A dictionary of table name to its number of rows.
+        '''
+
+        with self._lock:
+            connection = self._connect()
+            return {
+                table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ['tracks', 'track_artists', 'artists', 'audio_features']
+            }
+
+    def compact(self, max_age=None):
+        '''
+        Removes expired genres and audio features, and optionally tracks that haven't been seen in max_age
+        seconds (with their artists, if no other track has them), then rebuilds the database file so the
+        freed space is returned.
+
+        Args:
+            max_age: Optional seconds since a track was last seen before it is removed.
+
+        Returns:
+            A dictionary of the number of rows removed from each table.
+        '''
+
+        now = time.time()
+        removed = {}
+        with self._lock:
+            connection = self._connect()
+            removed['audio_features'] = connection.execute(
+                "DELETE FROM audio_features WHERE expires_at <= ?", (now,)
+            ).rowcount
+            connection.execute(
+                "UPDATE artists SET genres = NULL, genres_expires_at = NULL, genres_last_used = NULL "
+                "WHERE genres_expires_at <= ?", (now,)
+            )
+
+            removed['tracks'] = 0
+            if max_age != None:
+                removed['tracks'] = connection.execute(
+                    "DELETE FROM tracks WHERE updated_at <= ?", (now - max_age,)
+                ).rowcount
+            connection.execute("DELETE FROM track_artists WHERE track_id NOT IN (SELECT track_id FROM tracks)")
+
+            # Artists with no tracks and no genres left are of no further use
+            removed['artists'] = connection.execute(
+                "DELETE FROM artists WHERE genres IS NULL "
+                "AND artist_uri NOT IN (SELECT artist_uri FROM track_artists)"
+            ).rowcount
+            connection.commit()
+
+            connection.execute("VACUUM")
+            connection.execute("ANALYZE")
+        return removed
+
+
+
+
+class CatalogCache:
+    '''
+    Presents the artist genres or audio features in a TrackCatalog with the same interface as the caches in
+    caches.py, so the helpers can use the catalog wherever they take a cache. It is bounded: once it holds more
+    than max_size entries, the least recently used are evicted. Counters for hits, misses and evictions are
+    kept in stats.
+
+    The number of entries is counted once and then kept up to date from the entries each write adds. Other
+    processes sharing the catalog and compact() change it too, so it is only recounted before evicting.
+
+    Args:
+        catalog: The TrackCatalog.
+        kind: "artist_genres" or "audio_features".
+        ttl: The number of seconds an entry stays valid.
+        max_size: Optional most entries kept before the least recently used are evicted.
+    '''
+
+    def __init__(self, catalog, kind, ttl, max_size=None):
+        self.catalog = catalog
+        self.kind = kind
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = getattr(self.catalog, 'get_' + self.kind)(keys)
+        if self.max_size != None and found:
+            self.catalog.mark_used(self.kind, list(found))
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, values, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl == None else ttl)
+        added = getattr(self.catalog, 'upsert_' + self.kind)(values, expires_at)
+        if self.max_size == None:
+            return
+
+        with self._lock:
+            if self._size == None:
+                self._size = self.catalog.count(self.kind)
+            else:
+                self._size += added
+
+            if self._size > self.max_size:
+                self._size = self.catalog.count(self.kind)
+            if self._size > self.max_size:
+                evicted = self.catalog.evict_least_recently_used(
+                    self.kind, self._size - math.ceil(self.max_size * EVICT_TO)
+                )
+                self._size -= evicted
+                self.stats['evictions'] += evicted
+
+    def clear(self):
+        self.catalog.clear(self.kind)
+        with self._lock:
+            self._size = 0
+
+
+
+
+# Compacts the shared catalog: python catalog.py compact [max age in days]
+if __name__ == "__main__":
+    import helper_functions as helpers
+
+    if len(sys.argv) < 2 or sys.argv[1] != 'compact':
+        print("Usage: python catalog.py compact [max age in days]")
+        sys.exit(1)
+
+    max_age = float(sys.argv[2]) * 24 * 60 * 60 if len(sys.argv) > 2 else None
+    print("Before:", helpers.CATALOG.counts())
+    print("Removed:", helpers.CATALOG.compact(max_age=max_age))
+    print("After:", helpers.CATALOG.counts())
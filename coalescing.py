@@ -0,0 +1,235 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+import metrics
+import rate_limiter
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------LOOKUP COALESCING-----------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Seconds a lookup waits for other users' misses to fill a partial batch before sending it. Only waited while
+# other lookups are running, so a single user's lookups are never slowed down
+LINGER = 0.005
+
+
+
+
+class LookupCoalescer:
+    '''
+    Single-flight layer for Spotify lookups by ID (e.g., sp.artists, sp.audio_features), shared by all users.
+    Each ID is only requested once at a time: if a lookup is already fetching an ID, later lookups wait on the
+    same future instead of requesting it again. The IDs that running lookups still need are kept in queues (one
+    per priority) and every lookup sends them in full batches, so the misses of several users are merged into as
+    few API calls as possible.
+
+    A batch is sent with the Spotipy object of whichever lookup takes it from the queues, which is fine for
+    artists and audio features since they are the same for every user. An ID is queued at the most urgent
+    priority of the lookups that need it, and a lookup only takes IDs queued at its own priority or lower, so
+    background work never makes the calls a user is waiting on. If a batch fails, only the lookup that sent it
+    gets the error: the IDs other lookups need are queued again, and those lookups retry them with their own
+    Spotipy objects.
+
+    Args:
+        batch_size: The most IDs sent per call, e.g., 50 for sp.artists.
+        name: The endpoint the lookups are measured under, e.g., "artists".
+        linger: Seconds to wait for other lookups' misses before sending a partial batch.
+    '''
+
+    def __init__(self, batch_size, name, linger=LINGER):
+        self.batch_size = batch_size
+        self.name = name
+        self.linger = linger
+
+        # Future of every ID that is queued or being fetched, and how many running lookups of each priority
+        # need each ID, e.g., {"id": {INTERACTIVE: 1, BULK: 2}}
+        self._in_flight = {}
+        self._waiters = {}
+
+        # The queued IDs (oldest first) not yet taken into a batch, by priority, and the priority each is queued at
+        self._queues = {}
+        self._queued_at = {}
+
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def _enqueue(self, key, first=False):
+        priority = min(self._waiters[key])
+        queue = self._queues.setdefault(priority, OrderedDict())
+        queue[key] = None
+        if first:
+            queue.move_to_end(key, last=False)
+        self._queued_at[key] = priority
+
+    def _dequeue(self, key):
+        del self._queues[self._queued_at.pop(key)][key]
+
+    def _sendable(self, priority):
+        '''
+        Gets the queued IDs a lookup of the given priority may send, most urgent first. Must be called with the
+        condition held.
+        '''
+
+        for queue_priority in sorted(self._queues):
+            if queue_priority >= priority:
+                yield from self._queues[queue_priority]
+
+    def _take_batch(self, priority):
+        ids = []
+        for key in self._sendable(priority):
+            ids.append(key)
+            if len(ids) == self.batch_size:
+                break
+        for key in ids:
+            self._dequeue(key)
+        return ids
+
+    def _send(self, ids, sp, fetch, own_ids):
+        '''
+        Makes one call for ids and resolves their futures. If the call fails, the IDs other lookups need are
+        queued again for them to retry, and only the futures no one else needs get the error.
+
+        Returns:
+            The exception the call raised, or None if it succeeded.
+        '''
+
+        try:
+            values = fetch(sp, ids)
+            error = None
+        except Exception as fetch_error:
+            error = fetch_error
+
+        with self._condition:
+            for key in ids:
+                other_waiters = sum(self._waiters.get(key, {}).values()) - (1 if key in own_ids else 0)
+                if error != None and other_waiters > 0:
+                    self._enqueue(key, first=True)
+                elif error != None:
+                    self._in_flight.pop(key).set_exception(error)
+                else:
+                    self._in_flight.pop(key).set_result(values.get(key))
+            self._condition.notify_all()
+        return error
+
+    def _leave(self, futures, priority):
+        '''
+        Removes a finished lookup from the waiters of its IDs. IDs it leaves queued (after a failed call) are moved
+        to the priority of the lookups still waiting on them, or dropped if there are none. Must be called with
+        the condition held.
+        '''
+
+        for key in futures:
+            waiters = self._waiters[key]
+            waiters[priority] -= 1
+            if waiters[priority] == 0:
+                del waiters[priority]
+
+            if not waiters:
+                del self._waiters[key]
+                if key in self._queued_at:
+                    self._dequeue(key)
+                    self._in_flight.pop(key).cancel()
+            elif key in self._queued_at and self._queued_at[key] != min(waiters):
+                self._dequeue(key)
+                self._enqueue(key)
+
+    def get_many(self, ids, sp, fetch, stats=None):
+        '''
+        Gets the value of each ID, joining the fetches of IDs already in flight and sending the rest (along
+        with other lookups' queued IDs) in full batches.
+
+        Args:
+            ids: A list of unique IDs to look up, e.g., the cache misses of get_artist_genres.
+            sp: The Spotipy object used for accessing Spotipy methods. Its priority attribute (see
+                rate_limiter.RateLimitedSpotify) decides which queued IDs it may send; INTERACTIVE if it has none.
+            fetch: A function that takes a Spotipy object and a list of up to batch_size IDs, makes one API
+                call, and returns a dictionary of ID to value. IDs left out of it get None.
+            stats: Optional dictionary. If given, it is filled with the number of API calls this lookup made and
+                the number of its IDs that joined a fetch already in flight.
+
+        Returns:
+            A dictionary of each ID in ids to its value.
+
+        Raises:
+            The exception of a failed call made with sp. Failed calls made by other lookups are retried instead.
+        '''
+
+        priority = getattr(sp, 'priority', rate_limiter.INTERACTIVE)
+        futures = {}
+        joined = 0
+        api_calls = 0
+        with self._condition:
+            for key in ids:
+                waiters = self._waiters.setdefault(key, {})
+                waiters[priority] = waiters.get(priority, 0) + 1
+
+                future = self._in_flight.get(key)
+                if future == None:
+                    future = self._in_flight[key] = Future()
+                    self._enqueue(key)
+                else:
+                    joined += 1
+
+                    # A user waiting on an ID queued by background work moves it up to their own priority
+                    if key in self._queued_at and priority < self._queued_at[key]:
+                        self._dequeue(key)
+                        self._enqueue(key)
+                futures[key] = future
+            self._running += 1
+
+        if joined and metrics.ENABLED:
+            metrics.registry.inc('spotify_coalesced_lookups_total', {'endpoint': self.name}, joined)
+
+        try:
+            lingered = False
+            while True:
+
+                # Wait until every ID is resolved, or there are queued IDs this lookup may send. Until then, every
+                # pending ID is in a batch another lookup is sending or queued for a more urgent lookup, and this
+                # one is woken when they resolve them or queue them again after a failed call
+                with self._condition:
+                    while True:
+                        done = all(future.done() for future in futures.values())
+                        sendable = sum(1 for _ in self._sendable(priority))
+                        if done or sendable:
+                            break
+                        self._condition.wait()
+                    running = self._running
+                if done:
+                    break
+
+                # Give other users' lookups a moment to add their misses to a partial batch
+                if not lingered and running > 1 and sendable < self.batch_size:
+                    lingered = True
+                    time.sleep(self.linger)
+
+                # Send the next batch from the queues, whoever it belongs to
+                with self._condition:
+                    batch = self._take_batch(priority)
+                if batch:
+                    api_calls += 1
+                    error = self._send(batch, sp, fetch, futures)
+                    if error != None:
+                        raise error
+        finally:
+            with self._condition:
+                self._leave(futures, priority)
+                self._running -= 1
+                self._condition.notify_all()
+
+            if stats != None:
+                stats['api_calls'] = api_calls
+                stats['joined'] = joined
+
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,237 @@
+import heapq
+import math
+import scoring
+from helper_functions import AUDIO_FEATURES, PLAYLIST_SIZE
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-------------------------FEATURE INDEX-------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Most tracks kept in one leaf of the tree. Leaves are compared against the query all at once
+LEAF_SIZE = 32
+
+
+
+
+class FeatureIndexNode:
+    '''
+    One node of a FeatureIndex tree. Every node keeps the bounding box of its tracks' features and the OR of
+    their genre masks, so whole subtrees can be skipped when they are too far away or have none of the
+    selected genres. Leaves keep the range of their rows in the index's points; branches keep two children.
+    '''
+
+    def __init__(self, low, high, genre_mask, start=None, end=None, left=None, right=None):
+        self.low = low
+        self.high = high
+        self.genre_mask = genre_mask
+        self.start = start
+        self.end = end
+        self.left = left
+        self.right = right
+
+
+
+
+class FeatureIndex:
+    '''
+    A KD-tree over the audio features of a list of tracks, for finding the tracks closest to the slider
+    values on features.html without scoring every track. Distance is the sum of the absolute differences
+    between the track's features (0-100) and the slider values, the same delta feature_score_deduction
+    deducts 10% of, so the closest tracks are the ones that lose the fewest points. Uses NumPy when it is
+    installed, otherwise plain lists.
+
+    Tracks missing any audio feature can't be placed in the tree. They are kept aside and compared one by one
+    on every query, with missing features adding no distance (as in feature_score_deduction).
+
+    Args:
+        track_list: A list of track objects with audio features and genres set.
+        feature_names: The audio features indexed, in column order.
+        leaf_size: The most tracks kept in one leaf.
+    '''
+
+    def __init__(self, track_list, feature_names=AUDIO_FEATURES, leaf_size=LEAF_SIZE):
+        self.feature_names = list(feature_names)
+        self.size = len(track_list)
+        self.genre_ids, self.track_masks = scoring.build_genre_index(track_list)
+
+        # Split tracks into those that can be placed in the tree and those missing a feature
+        positions = []
+        rows = []
+        self.unindexed_positions = []
+        self.unindexed_rows = []
+        for position, track in enumerate(track_list):
+            values = [track[feature_name] for feature_name in self.feature_names]
+            if None in values:
+                self.unindexed_positions.append(position)
+                self.unindexed_rows.append([math.nan if value == None else value * 100 for value in values])
+            else:
+                positions.append(position)
+                rows.append([value * 100 for value in values])
+
+        self.positions = positions
+        if scoring.np == None:
+            self.points = rows
+        else:
+            self.points = scoring.np.array(rows, dtype=scoring.np.float64).reshape(len(rows), len(self.feature_names))
+
+        # Build the tree, then store the rows in tree order so each leaf's rows sit next to each other
+        self._tree_rows = []
+        self.root = self._build(list(range(len(rows))), leaf_size) if rows else None
+        self.positions = [positions[row] for row in self._tree_rows]
+        if scoring.np == None:
+            self.points = [rows[row] for row in self._tree_rows]
+        else:
+            self.points = self.points[scoring.np.array(self._tree_rows, dtype=scoring.np.intp)]
+        del self._tree_rows
+
+    def _bounds(self, rows):
+        if scoring.np == None:
+            columns = list(zip(*[self.points[row] for row in rows]))
+            return [min(column) for column in columns], [max(column) for column in columns]
+        points = self.points[rows]
+        return points.min(axis=0).tolist(), points.max(axis=0).tolist()
+
+    def _build(self, rows, leaf_size):
+        low, high = self._bounds(rows)
+        genre_mask = 0
+        for row in rows:
+            genre_mask |= self.track_masks[self.positions[row]]
+
+        if len(rows) <= leaf_size:
+            start = len(self._tree_rows)
+            self._tree_rows.extend(rows)
+            return FeatureIndexNode(low, high, genre_mask, start=start, end=len(self._tree_rows))
+
+        # Split on the median of the feature with the widest spread
+        spreads = [high[column] - low[column] for column in range(len(self.feature_names))]
+        split_column = spreads.index(max(spreads))
+        if scoring.np == None:
+            rows = sorted(rows, key=lambda row: (self.points[row][split_column], row))
+        else:
+            rows = scoring.np.array(rows, dtype=scoring.np.intp)
+            rows = rows[scoring.np.lexsort((rows, self.points[rows, split_column]))].tolist()
+        middle = len(rows) // 2
+        return FeatureIndexNode(
+            low, high, genre_mask,
+            left=self._build(rows[:middle], leaf_size),
+            right=self._build(rows[middle:], leaf_size)
+        )
+
+    def _box_distance(self, node, query, columns):
+
+        # The smallest distance from the query to any point in the node's bounding box
+        distance = 0.0
+        for column, value in zip(columns, query):
+            if value < node.low[column]:
+                distance += node.low[column] - value
+            elif value > node.high[column]:
+                distance += value - node.high[column]
+        return distance
+
+    def _leaf_distances(self, node, query, columns):
+        if scoring.np == None:
+            return [
+                sum(abs(self.points[row][column] - value) for column, value in zip(columns, query))
+                for row in range(node.start, node.end)
+            ]
+        points = self.points[node.start:node.end]
+        if len(columns) != len(self.feature_names):
+            points = points[:, columns]
+        return scoring.np.abs(points - query).sum(axis=1).tolist()
+
+    def query(self, input_values, k=PLAYLIST_SIZE, genre_input=None):
+        '''
+        Finds the k tracks closest to the user's slider values. Searches the tree closest subtree first and
+        skips every subtree that can't hold a closer track, so only a small part of the index is compared.
+
+        Args:
+            input_values: The values (0-100) of each slider on features.html, by audio feature name. Features
+                that are left out aren't compared.
+            k: The number of tracks to find.
+            genre_input: Optional list of genres. Only tracks with at least one of them are returned.
+
+        Returns:
+            A list of (position, distance) tuples for the closest tracks, closest first, where position is
+            the track's position in the indexed track_list. Tracks at equal distances are ordered by position.
+        '''
+
+        if k <= 0:
+            return []
+
+        columns = [column for column, name in enumerate(self.feature_names) if name in input_values]
+        query = [float(input_values[self.feature_names[column]]) for column in columns]
+
+        genre_mask = None
+        if genre_input != None:
+            genre_mask = scoring.compile_genre_mask(genre_input, self.genre_ids)
+            if genre_mask == 0:
+                return []
+
+        def matches(position):
+            return genre_mask == None or self.track_masks[position] & genre_mask
+
+        # Max heap (by negated distance, then position) of the k closest tracks found so far
+        closest = []
+
+        def offer(position, distance):
+            entry = (-distance, -position)
+            if len(closest) < k:
+                heapq.heappush(closest, entry)
+            elif entry > closest[0]:
+                heapq.heapreplace(closest, entry)
+
+        for position, row in zip(self.unindexed_positions, self.unindexed_rows):
+            if matches(position):
+                distance = 0.0
+                for column, value in zip(columns, query):
+                    if not math.isnan(row[column]):
+                        distance += abs(row[column] - value)
+                offer(position, distance)
+
+        if self.root != None:
+            if scoring.np != None:
+                query_array = scoring.np.array(query, dtype=scoring.np.float64)
+            else:
+                query_array = query
+
+            # Nodes to visit, nearest bounding box first
+            counter = 0
+            nodes = [(self._box_distance(self.root, query, columns), counter, self.root)]
+            while nodes:
+                box_distance, _, node = heapq.heappop(nodes)
+
+                # Every remaining node is at least this far away, so none can hold a closer track
+                if len(closest) == k and box_distance > -closest[0][0]:
+                    break
+                if genre_mask != None and not node.genre_mask & genre_mask:
+                    continue
+
+                if node.start == None:
+                    for child in (node.left, node.right):
+                        child_distance = self._box_distance(child, query, columns)
+                        if len(closest) < k or child_distance <= -closest[0][0]:
+                            counter += 1
+                            heapq.heappush(nodes, (child_distance, counter, child))
+                    continue
+
+                distances = self._leaf_distances(node, query_array, columns)
+                for row, distance in enumerate(distances, node.start):
+                    if len(closest) == k and distance > -closest[0][0]:
+                        continue
+                    position = self.positions[row]
+                    if matches(position):
+                        offer(position, distance)
+
+        return [
+            (-negative_position, -negative_distance) for negative_distance, negative_position in sorted(closest, reverse=True)
+        ]
@@ -1,4 +1,72 @@
+import contextvars
 import random
+from concurrent.futures import ThreadPoolExecutor
+import catalog
+import coalescing
+import metrics
+import scoring
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-------------------------CONFIGURATION-------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Maximum number of top tracks pages (50 tracks each) requested from Spotify at the same time
+TOP_TRACKS_MAX_WORKERS = 5
+
+# Maximum number of sp.recommendations calls made at the same time in get_new_tracks
+RECOMMENDATIONS_MAX_WORKERS = 8
+
+# Number of seed tracks sent per sp.recommendations call, and the most seed windows used
+RECOMMENDATIONS_SEED_SIZE = 5
+RECOMMENDATIONS_MAX_WINDOWS = 100
+
+# The audio features used by the program, as named in sp.audio_features responses and track objects
+AUDIO_FEATURES = [
+    'acousticness',
+    'danceability',
+    'energy',
+    'instrumentalness',
+    'liveness',
+    'speechiness',
+    'valence'
+]
+
+# Number of tracks in the final playlist
+PLAYLIST_SIZE = 30
+
+# Local SQLite database holding the catalog below
+CACHE_PATH = 'spotify_cache.sqlite3'
+
+# Catalog of every track, artist and audio features record seen, shared by all users. Tracks are hydrated from
+# it before asking Spotify. Set to None to always use the Spotify API. Compact it with: python catalog.py compact
+CATALOG = catalog.TrackCatalog(CACHE_PATH, AUDIO_FEATURES)
+
+# Process-wide cache of artist URI to genres, kept in the catalog. Genres rarely change, so entries are kept
+# for a week, and the least recently used genres are evicted past 100,000 artists
+ARTIST_GENRES_CACHE = catalog.CatalogCache(CATALOG, 'artist_genres', ttl=7 * 24 * 60 * 60, max_size=100000)
+
+# Process-wide cache of track_id to audio features, kept in the catalog. Audio features never change, so entries
+# are kept for 30 days, and the least recently used records are evicted past 500,000 tracks. Tracks Spotify has no audio 
+# features for are cached as None for a day, so they aren't requested on every page load. Any cache from
+# caches.py (e.g., caches.MemoryCache) can be swapped in for a cache that isn't kept in the catalog.
+AUDIO_FEATURES_CACHE = catalog.CatalogCache(CATALOG, 'audio_features', ttl=30 * 24 * 60 * 60, max_size=500000)
+AUDIO_FEATURES_NEGATIVE_TTL = 24 * 60 * 60
+
+# Process-wide single-flight layers for the artist and audio features cache misses. An ID already being fetched
+# for one user isn't requested again for another, and misses from several users are sent together in full
+# batches (50 for sp.artists, 100 for sp.audio_features). Set to None to send each user's misses on their own.
+ARTIST_LOOKUPS = coalescing.LookupCoalescer(batch_size=50, name='artists')
+AUDIO_FEATURES_LOOKUPS = coalescing.LookupCoalescer(batch_size=100, name='audio_features')
 
 
 
@@ -14,14 +82,97 @@ import random
 
 
 
-def get_top_tracks(offset, sp):
+def get_album_art_url(track):
+    '''
+    Gets the URL of the largest album image from a Spotify track response.
+
+    Args:
+        track: A track from a Spotify response, e.g., an item from sp.current_user_top_tracks or sp.tracks.
+
+    Returns:
+        The album art URL, or None if the album has no images.
+    '''
+
+    images = track['album'].get('images') or []
+    if len(images) == 0:
+        return None
+    return images[0]['url']
+
+
+
+
+def create_track_object(track):
+    '''
+    Parses all track data needed for the program from a Spotify track response into a track object. Album
+    art is captured here, since it is already in the response, so it doesn't need to be requested later.
+
+    Args:
+        track: A track from a Spotify response, e.g., an item from sp.current_user_top_tracks or sp.tracks.
+
+    Returns:
+        A track object.
+    '''
+
+    return create_catalog_track_object({
+        'track_id': track['id'],
+        'track_uri': track['uri'],
+        'artists': [artist['name'] for artist in track['artists']],
+        'artist_uris': [artist['uri'] for artist in track['artists']],
+        'track_name': track['name'],
+        'album_name': track['album']['name'],
+        'album_art': get_album_art_url(track)
+    })
+
+
+
+
+def create_catalog_track_object(record):
+    '''
+    Creates a track object from a track's details, as parsed by create_track_object or stored in the catalog.
+    Genres, audio features and score are set to their defaults.
+
+    Args:
+        record: A dictionary of the track_id, track_uri, artists, artist_uris, track_name, album_name and
+            album_art of the track.
+
+    Returns:
+        A track object.
+    '''
+
+    return {
+        'track_id': record['track_id'],
+        'track_uri': record['track_uri'],
+        'artists': record['artists'],
+        'artist_uris': record['artist_uris'],
+        'track_name': record['track_name'],
+        'album_name': record['album_name'],
+        'album_art': record['album_art'],
+        'genres': [],
+        'acousticness': 1.0,
+        'danceability': 1.0,
+        'energy': 1.0,
+        'instrumentalness': 1.0,
+        'liveness': 1.0,
+        'speechiness': 1.0,
+        'valence': 1.0,
+        'score': 100.00,
+        'missing_audio_features': False
+    }
+
+
+
+
+@metrics.timed_stage('get_top_tracks')
+def get_top_tracks(offset, sp, catalog=CATALOG):
     '''
     Gets the current user's top tracks. Each track is a dictionary object with several parameters
-    for later use in the program, such as track_name and artists. 
+    for later use in the program, such as track_name and artists. Top tracks are different for every user,
+    so they always come from Spotify, but they are saved to catalog for hydrating later lookups.
 
     Args:
         offset: The value to specify the offset for the current_user_top_tracks Spotipy method.
         sp: The Spotipy object used for accessing Spotipy methods.
+        catalog: The track catalog, or None to not save the tracks.
 
     Returns:
         A list of 50 track objects.
@@ -35,169 +186,256 @@ def get_top_tracks(offset, sp):
     # in main.py new_or_familiar_page()
     new_tracks = []
     for track in top_tracks['items']:
-        track_object = {
-            'track_id': track['id'],
-            'track_uri': track['uri'],
-            'artists': [artist['name'] for artist in track['artists']],
-            'artist_uris': [artist['uri'] for artist in track['artists']],
-            'track_name': track['name'],
-            'album_name': track['album']['name'],
-            'genres': [],
-            'acousticness': 1.0,
-            'danceability': 1.0,
-            'energy': 1.0,
-            'instrumentalness': 1.0,
-            'liveness': 1.0,
-            'speechiness': 1.0,
-            'valence': 1.0,
-            'score': 100.00,
-            'missing_audio_features': False
-        }
-        new_tracks.append(track_object)
+        new_tracks.append(create_track_object(track))
+
+    if catalog != None and new_tracks:
+        catalog.upsert_tracks(new_tracks)
 
     return new_tracks
 
 
 
 
-def get_audio_features(track_list, sp):
+def stream_top_tracks(sp, total=500, page_size=50, max_workers=TOP_TRACKS_MAX_WORKERS):
+    '''
+    Generator that streams in up to total of the current user's top tracks page by page. Every page of 
+    get_top_tracks is requested concurrently, and each page is yielded as soon as it (and the pages before it)
+    arrive, so callers can start working on the first tracks while the rest are still being requested.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        total: The maximum number of top tracks to get (Spotify allows up to 500).
+        page_size: The number of tracks requested per page (Spotify allows up to 50).
+        max_workers: The maximum number of pages requested at the same time.
+
+    Yields:
+        A list of track objects for each page, in the same order Spotify ranks them.
+    '''
+
+    offsets = list(range(0, total, page_size))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+
+        # Submit every page up front; the executor only runs max_workers of them at a time. Each page runs in
+        # a copy of this context, so its stages and Spotify responses are added to the request's trace
+        futures = [
+            executor.submit(contextvars.copy_context().run, get_top_tracks, offset, sp) for offset in offsets
+        ]
+        try:
+
+            # Yield the pages in offset order so the tracks keep Spotify's ranking
+            for future in futures:
+                new_tracks = future.result()
+                if new_tracks:
+                    yield new_tracks
+
+                # A short page means the user has no more top tracks. The rest can only be empty
+                if len(new_tracks) < page_size:
+                    break
+        finally:
+
+            # Cancel the pages that haven't started yet, whether the user ran out of top tracks or the caller
+            # stopped early
+            for pending in futures:
+                pending.cancel()
+
+
+
+
+@metrics.timed_stage('get_all_top_tracks')
+def get_all_top_tracks(sp, total=500, page_size=50, max_workers=TOP_TRACKS_MAX_WORKERS):
+    '''
+    Gets up to total of the current user's top tracks by requesting every page of get_top_tracks
+    concurrently instead of one after the other.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        total: The maximum number of top tracks to get (Spotify allows up to 500).
+        page_size: The number of tracks requested per page (Spotify allows up to 50).
+        max_workers: The maximum number of pages requested at the same time.
+
+    Returns:
+        A list of track objects, in the same order Spotify ranks them.
+    '''
+
+    track_list = []
+    for new_tracks in stream_top_tracks(sp, total=total, page_size=page_size, max_workers=max_workers):
+        track_list.extend(new_tracks)
+    return track_list
+
+
+
+
+def set_track_audio_features(track, track_audio):
+    '''
+    Sets each audio feature in AUDIO_FEATURES on a track object from one sp.audio_features record. If a 
+    feature does not exist (None), the track keeps its default value and the missing features flag is set 
+    to True for later handling (not currently used in the program).
+
+    Args:
+        track: A track object from track_list.
+        track_audio: The audio features record for the track, as returned by sp.audio_features.
+
+    Returns:
+        track, updated with its audio features.
+    '''
+
+    for feature_name in AUDIO_FEATURES:
+        feature_value = track_audio.get(feature_name)
+        if feature_value != None:
+            track[feature_name] = feature_value
+        else:
+            track['missing_audio_features'] = True
+
+    return track
+
+
+
+
+def fetch_audio_features(sp, track_ids):
+    '''
+    Requests the audio features of up to 100 tracks with one sp.audio_features call.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        track_ids: A list of up to 100 track_ids.
+
+    Returns:
+        A dictionary of track_id to its audio features record (its id and each feature in AUDIO_FEATURES), or
+        to None if Spotify has no audio features for the track.
+    '''
+
+    audio_features_list = sp.audio_features(tracks=track_ids)
+
+    # Spotify returns None in place of tracks it has no audio features for
+    fetched_audio_features = {}
+    for requested_id, track_audio in zip(track_ids, audio_features_list):
+        if track_audio != None:
+            fetched_audio_features[track_audio['id']] = {
+                feature_name: track_audio.get(feature_name) for feature_name in ['id'] + AUDIO_FEATURES
+            }
+        else:
+            fetched_audio_features[requested_id] = None
+    return fetched_audio_features
+
+
+
+
+@metrics.timed_stage('get_audio_features')
+def get_audio_features(track_list, sp, cache=AUDIO_FEATURES_CACHE, lookups=AUDIO_FEATURES_LOOKUPS):
     '''
-    Gets and sets the audio features for each track in track_list using Spotipy's 
-    audio_features method.
+    Gets and sets the audio features for each track in track_list. Tracks found in cache are not looked up
+    again; the rest are requested with Spotipy's audio_features method (through lookups, so misses shared with
+    other users are only requested once) and saved to cache.
 
     Args:
         track_list: The track_list object from the Flask session.
         sp: The Spotipy object used for accessing Spotipy methods.
+        cache: The audio features cache, or None to always use the Spotify API.
+        lookups: The audio features LookupCoalescer, or None to request the misses directly.
 
     Returns:
         track_list, updated with the audio features set on each track.
     '''
 
-    # Get track_ids for all tracks in track_list for easier lookup
-    track_ids = []
+    # Index every track in track_list by track_id once, so each audio features record finds its track
+    # with a dictionary lookup instead of scanning all of track_list
+    tracks_by_id = {}
     for track in track_list:
-        track_ids.append(track['track_id'])
-
-    # sp.audio_features has an upper limit of 100 track ids it can accept. This block uses an iterator, 
-    # remainder, and offset to loop through all tracks in track_list (which can have up to 500 tracks)
-    iterations = len(track_list) // 100
-    remainder = len(track_list) % 100
-    if remainder > 0:
-        iterations += 1
-    offset = 0
-    for i in range(iterations):
-
-        # Instantiate audio_features_list to get all audio features for the current group of 100 or
-        # less tracks
-        audio_features_list = []
-
-        # Try/except block needed for the final iteration in this loop, which can have a variable
-        # number. Needed to do this to prevent an error when getting the final index of track_ids
-        try:
-            audio_features_list = sp.audio_features(tracks=track_ids[offset:offset+100])
-        except:
-            audio_features_list = sp.audio_features(tracks=track_ids[offset:])
-        
-        # Loop to set the audio features for each value if the feature exists, else None
-        for track_audio in audio_features_list:
-            if track_audio != None:
-
-                # Look for a match in the current track_list
-                for main_track in track_list:
-
-                    # For each audio feature, set the value. If it does not exist (None), change the missing 
-                    # features flag to True for later handling (not currently used in the program)
-                    if track_audio['id'] == main_track['track_id']:
-                        if track_audio['acousticness'] != None:
-                            main_track['acousticness'] = track_audio['acousticness']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['danceability'] != None:
-                            main_track['danceability'] = track_audio['danceability']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['energy'] != None:
-                            main_track['energy'] = track_audio['energy']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['instrumentalness'] != None:
-                            main_track['instrumentalness'] = track_audio['instrumentalness']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['liveness'] != None:
-                            main_track['liveness'] = track_audio['liveness']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['speechiness'] != None:
-                            main_track['speechiness'] = track_audio['speechiness']
-                        else:
-                            main_track['missing_audio_features'] = True
-                        if track_audio['valence'] != None:
-                            main_track['valence'] = track_audio['valence']
-                        else:
-                            main_track['missing_audio_features'] = True
-        offset += 100
+        tracks_by_id.setdefault(track['track_id'], []).append(track)
+    track_ids = list(tracks_by_id)
+
+    # Use cached audio features where possible. A cached None means Spotify has no audio features for the 
+    # track, so it isn't requested again either
+    audio_features_by_id = {}
+    if cache != None:
+        audio_features_by_id.update(cache.get_many(track_ids))
+    missing_track_ids = [track_id for track_id in track_ids if track_id not in audio_features_by_id]
+
+    # sp.audio_features has an upper limit of 100 track ids it can accept, so the misses (which can have up to
+    # 500 tracks) are sent in groups of 100
+    fetched_audio_features = {}
+    if lookups != None and missing_track_ids:
+        fetched_audio_features.update(lookups.get_many(missing_track_ids, sp, fetch_audio_features))
+    else:
+        for offset in range(0, len(missing_track_ids), 100):
+            fetched_audio_features.update(fetch_audio_features(sp, missing_track_ids[offset:offset+100]))
+
+    if cache != None and fetched_audio_features:
+        found = {track_id: features for track_id, features in fetched_audio_features.items() if features != None}
+        not_found = {track_id: None for track_id, features in fetched_audio_features.items() if features == None}
+        if found:
+            cache.set_many(found)
+        if not_found:
+            cache.set_many(not_found, ttl=AUDIO_FEATURES_NEGATIVE_TTL)
+    audio_features_by_id.update(fetched_audio_features)
+
+    for track_id, track_audio in audio_features_by_id.items():
+        if track_audio != None:
+            for main_track in tracks_by_id.get(track_id, []):
+                set_track_audio_features(main_track, track_audio)
 
     return track_list
 
 
 
 
-def set_novel_track_list(ids, sp):
+@metrics.timed_stage('set_novel_track_list')
+def set_novel_track_list(ids, sp, catalog=CATALOG):
     '''
-    Gets track objects from 50 supplied track_ids (parameter = ids). Parses all track information
-    into new track objects, similar to get_top_tracks.
+    Gets track objects from 50 supplied track_ids (parameter = ids). Tracks found in catalog are created
+    from it; the rest are requested with Spotipy's tracks method, parsed into new track objects similar to 
+    get_top_tracks, and saved to catalog.
 
     Args:
         ids: The Spotify IDs of 50 songs.
         sp: The Spotipy object used for accessing Spotipy methods.
+        catalog: The track catalog, or None to always use the Spotify API.
 
     Returns:
         A list of 50 track objects to be extended into a new track_list.
     '''
 
+    tracks_by_id = {}
+    if catalog != None:
+        for track_id, record in catalog.get_tracks(ids).items():
+            tracks_by_id[track_id] = create_catalog_track_object(record)
+    missing_ids = [track_id for track_id in ids if track_id not in tracks_by_id]
 
     # sp.tracks only accepts up to 50 track IDs, so this needs to loop in get_new_tracks if there are 
     # more than 50 available tracks
-    tracks_results = sp.tracks(ids)
+    if missing_ids:
+        tracks_results = sp.tracks(missing_ids)
+        fetched_tracks = [create_track_object(track) for track in tracks_results['tracks'] if track != None]
+        if catalog != None and fetched_tracks:
+            catalog.upsert_tracks(fetched_tracks)
+        for track in fetched_tracks:
+            tracks_by_id[track['track_id']] = track
+
+    # Keep the order of ids
     new_tracks = []
-    for track in tracks_results['tracks']:
-        track_object = {
-            'track_id': track['id'],
-            'track_uri': track['uri'],
-            'artists': [artist['name'] for artist in track['artists']],
-            'artist_uris': [artist['uri'] for artist in track['artists']],
-            'track_name': track['name'],
-            'album_name': track['album']['name'],
-            'genres': [],
-            'acousticness': 1.0,
-            'danceability': 1.0,
-            'energy': 1.0,
-            'instrumentalness': 1.0,
-            'liveness': 1.0,
-            'speechiness': 1.0,
-            'valence': 1.0,
-            'score': 100.00,
-            'missing_audio_features': False
-        }
-        new_tracks.append(track_object)
+    for track_id in ids:
+        if track_id in tracks_by_id:
+            new_tracks.append(tracks_by_id[track_id])
 
     return new_tracks
 
 
 
 
-def get_new_tracks(track_list, sp):
+@metrics.timed_stage('get_new_track_ids')
+def get_new_track_ids(track_list, sp, max_workers=RECOMMENDATIONS_MAX_WORKERS):
     '''
-    Gets new tracks to replace track_list in the Flask session. This is invoked when users select
-    the "New" button on newOrFamiliar.html. 
+    Gets the IDs of recommended tracks that aren't already in track_list, using Spotipy's recommendations
+    method seeded with the tracks in track_list.
 
     Args:
         track_list: The track_list object from the Flask session.
         sp: The Spotipy object used for accessing Spotipy methods.
+        max_workers: The maximum number of sp.recommendations calls made at the same time.
 
     Returns:
-        track_list, updated with all new tracks.
+        A list of new track IDs, without duplicates.
     '''
 
     # Get IDs for all familiar tracks from initial values of track_list for later comparison
@@ -207,63 +445,160 @@ def get_new_tracks(track_list, sp):
         # Create a lightweight list of just the track_ids
         familiar_track_ids.append(track['track_id']) 
 
+    # Split familiar_track_ids into windows of 5 seed tracks. Each track in the top 500 is fed to 
+    # sp.recommendations to get new tracks, which results in a list of up to 500 new tracks to replace the 
+    # "familiar" track_list. Windows past the end of familiar_track_ids are skipped rather than sent as 
+    # empty seeds.
+    seed_windows = []
+    for start in range(0, len(familiar_track_ids), RECOMMENDATIONS_SEED_SIZE):
+        if len(seed_windows) == RECOMMENDATIONS_MAX_WINDOWS:
+            break
+        seed_windows.append(familiar_track_ids[start:start+RECOMMENDATIONS_SEED_SIZE])
+
+    # Gets sp.recommendations for every window concurrently, each in a copy of this context so the calls
+    # keep the request's trace. The responses are collected in window order, so the merged list is the same 
+    # no matter which call finishes first.
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, sp.recommendations, seed_tracks=seeds, limit=5)
+            for seeds in seed_windows
+        ]
+        recommendations = [future.result() for future in futures]
+
     # Instantiate list to collect track ids of recommended tracks
     new_track_ids = []
-
-    familiar_track_counter = 0
-
-    # Loops over the entire track_list (500 tracks) 50 times in 5-item increments. This is so that 
-    # each track in the top 100 is fed to sp.recommendations to get new tracks. This results in a list 
-    # of 500 new tracks to replace the "familiar" track_list.
-    for familiar_track_group in range(100):
-
-        # Gets sp.recommendations for familiar tracks in track_list n through n+5
-        recommended_tracks = sp.recommendations(seed_tracks=familiar_track_ids[familiar_track_counter:familiar_track_counter+5], limit=5)
-
+    for recommended_tracks in recommendations:
         for recommended_track in recommended_tracks['tracks']:
             
             # Adds the track ID to the new list
             new_track_ids.append(recommended_track['id'])
 
-        # Increments so that the loop uses the next 5 familiar tracks in track_list for new recommendations
-        familiar_track_counter += 5
-
     # Checks if new_track_ids exist in familiar_track_ids; removes duplicates and builds a new list of ids
     # This is so that the user truly finds new music using the app. The sp.recommendations method doesn't 
     # necessarily return new music.
-    actually_new_track_ids = [id for id in new_track_ids if id not in familiar_track_ids]
+    familiar_track_id_set = set(familiar_track_ids)
+    actually_new_track_ids = [id for id in new_track_ids if id not in familiar_track_id_set]
     
-    # Converts to a set, then back to a list to remove duplicates within itself, incase recommendations overlapped
-    cleaned_new_track_ids = list(set(actually_new_track_ids)) 
+    # Removes duplicates within itself, incase recommendations overlapped. dict.fromkeys keeps the first 
+    # occurrence of each id so the order stays deterministic
+    cleaned_new_track_ids = list(dict.fromkeys(actually_new_track_ids))
 
-    # Delete contents of track_list to make room for novel track objects
-    track_list = []
+    return cleaned_new_track_ids
 
-    # sp.audio_features (invoked in set_novel_track_list) has an upper limit of 50 track ids it can 
-    # accept. This block uses an iterator, remainder, and offset to loop through all tracks in track_list 
-    # (which can have up to 500 tracks)
-    iterations = len(cleaned_new_track_ids) // 50
-    remainder = len(cleaned_new_track_ids) % 50
-    if remainder > 0:
-        iterations += 1
-    offset = 0
-
-    # For each group of 50 tracks, get the track details and .extend() into track_list
-    for i in range(iterations):
-        try:
-            new_tracks = set_novel_track_list(cleaned_new_track_ids[offset:offset+50], sp)
-            track_list.extend(new_tracks)
-        except:
-            new_tracks = set_novel_track_list(cleaned_new_track_ids[offset:], sp)
-            track_list.extend(new_tracks)
-        offset += 50
+
+
+
+@metrics.timed_stage('get_new_tracks')
+def get_new_tracks(track_list, sp, max_workers=RECOMMENDATIONS_MAX_WORKERS):
+    '''
+    Gets new tracks to replace track_list in the Flask session. This is invoked when users select
+    the "New" button on newOrFamiliar.html. 
+
+    Args:
+        track_list: The track_list object from the Flask session.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        max_workers: The maximum number of Spotify calls made at the same time.
+
+    Returns:
+        track_list, updated with all new tracks.
+    '''
+
+    cleaned_new_track_ids = get_new_track_ids(track_list, sp, max_workers=max_workers)
+
+    # sp.tracks (invoked in set_novel_track_list) has an upper limit of 50 track ids it can accept, so 
+    # split the new track ids (up to 500) into groups of 50
+    id_groups = [cleaned_new_track_ids[offset:offset+50] for offset in range(0, len(cleaned_new_track_ids), 50)]
+
+    # Get the track details for each group concurrently (each in a copy of this context, so the stages keep 
+    # the request's trace), and .extend() them into the new track_list in order
+    track_list = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, set_novel_track_list, ids, sp) for ids in id_groups
+        ]
+        for future in futures:
+            track_list.extend(future.result())
 
     return track_list
-    
 
-    
 
-def set_artist_genres(track_list, sp):
+
+
+def fetch_artist_genres(sp, artist_uris):
+    '''
+    Requests the genres of up to 50 artists with one sp.artists call.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        artist_uris: A list of up to 50 artist URIs.
+
+    Returns:
+        A dictionary of artist URI to that artist's list of genres. Artists Spotify didn't find are left out.
+    '''
+
+    artists_list = sp.artists(artist_uris)
+    return {artist['uri']: artist['genres'] for artist in artists_list['artists'] if artist != None}
+
+
+
+
+@metrics.timed_stage('get_artist_genres')
+def get_artist_genres(artist_uris, sp, cache=ARTIST_GENRES_CACHE, stats=None, lookups=ARTIST_LOOKUPS):
+    '''
+    Gets the genres of each artist in artist_uris. Artists found in cache are not looked up again; only the 
+    misses are requested with Spotipy's artists method (through lookups, so misses shared with other users are
+    only requested once), and their genres are saved to cache.
+
+    Args:
+        artist_uris: A list of unique artist URIs.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        cache: The artist genres cache, or None to always use the Spotify API.
+        stats: Optional dictionary. If given, it is filled with the number of cache hits and misses, the
+            sp.artists calls made, and the misses that joined another user's call instead.
+        lookups: The artist LookupCoalescer, or None to request the misses directly.
+
+    Returns:
+        A dictionary of artist URI to that artist's list of genres.
+    '''
+
+    genres_by_uri = {}
+    if cache != None:
+        genres_by_uri.update(cache.get_many(artist_uris))
+    missing_uris = [artist_uri for artist_uri in artist_uris if artist_uri not in genres_by_uri]
+
+    # sp.artists has an upper limit of 50 artist_uris it can accept, so the misses are sent in groups of 50.
+    # Artists Spotify didn't find come back from lookups as None and are left out
+    fetched_genres_by_uri = {}
+    coalescer_stats = {'api_calls': 0, 'joined': 0}
+    if lookups != None and missing_uris:
+        fetched = lookups.get_many(missing_uris, sp, fetch_artist_genres, stats=coalescer_stats)
+        for artist_uri, artist_genres in fetched.items():
+            if artist_genres != None:
+                fetched_genres_by_uri[artist_uri] = artist_genres
+    else:
+        for offset in range(0, len(missing_uris), 50):
+            fetched_genres_by_uri.update(fetch_artist_genres(sp, missing_uris[offset:offset+50]))
+            coalescer_stats['api_calls'] += 1
+
+    if cache != None and fetched_genres_by_uri:
+        cache.set_many(fetched_genres_by_uri)
+    genres_by_uri.update(fetched_genres_by_uri)
+
+    # The API calls are the ones actually made with sp; with lookups, that includes other users' IDs sent in the
+    # same batches, and leaves out the IDs that joined other users' calls
+    if stats != None:
+        stats['artist_cache_hits'] = len(artist_uris) - len(missing_uris)
+        stats['artist_cache_misses'] = len(missing_uris)
+        stats['artist_api_calls'] = coalescer_stats['api_calls']
+        stats['artist_lookups_joined'] = coalescer_stats['joined']
+
+    return genres_by_uri
+
+
+
+
+@metrics.timed_stage('set_artist_genres')
+def set_artist_genres(track_list, sp, stats=None):
     '''
     Gets and sets the genres of each track. Genres are properties of artists, not tracks. This function gets the 
     genre(s) of the artist(s) for each track and set it to track["genres"].
@@ -271,55 +606,40 @@ def set_artist_genres(track_list, sp):
     Args:
         track_list: The track_list object from the Flask session.
         sp: The Spotipy object used for accessing Spotipy methods.
+        stats: Optional dictionary. If given, it is filled with counters on how many artist lookups, cache hits
+            and sp.artists calls were needed, and how many calls deduplicating and caching the artists saved.
 
     Returns:
         track_list, updated with genres.
     '''
 
-    # Get a list of all artist uris
-    artist_uris = []
+    # Build an index of artist uri to the tracks that artist appears on. The keys are the unique artist uris,
+    # so an artist that appears on many tracks is only looked up once
+    tracks_by_artist_uri = {}
+    artist_uri_count = 0
     for track in track_list:
         for artist_uri in track['artist_uris']:
-            artist_uris.append(artist_uri)
-    
-    # sp.artists has an upper limit of 50 artist_uris it can accept. This block uses an iterator, remainder, and 
-    # offset to loop through all artists in artist_uris. 
-    iterations = len(artist_uris) // 50
-    remainder = len(artist_uris) % 50
-    if remainder > 0:
-        iterations += 1
-    offset = 0
+            tracks_by_artist_uri.setdefault(artist_uri, []).append(track)
+            artist_uri_count += 1
+    artist_uris = list(tracks_by_artist_uri)
 
+    lookup_stats = {}
+    genres_by_uri = get_artist_genres(artist_uris, sp, stats=lookup_stats)
 
-    for i in range(iterations):
-
-        # Instantiate dictionary of artists, returned from sp.artists()
-        artists_list = {}
-
-        # Try/except block needed for the final iteration in this loop, which can have a variable
-        # number. Needed to do this to prevent an error when getting the final index of artist_uris.
-        try:
-            artists_list = sp.artists(artist_uris[offset:offset+50])
-        except:
-            artists_list = sp.artists(artist_uris[offset:])
+    # Add each artist's genres to every track they appear on
+    for artist_uri, artist_genres in genres_by_uri.items():
+        for track_object in tracks_by_artist_uri.get(artist_uri, []):
 
-        # For each artist...
-        for artist in artists_list['artists']:
+            # Remove duplicate genres, for if one track has several artists that share a genre. dict.fromkeys
+            # keeps the genres in the order they were found
+            track_object['genres'] = list(dict.fromkeys(track_object['genres'] + artist_genres))
 
-            # Compare to each track object in track_list...
-            for track_object in track_list:
-
-                # Then further look for a match in the list of artist_uris...
-                for track_object_uri in track_object['artist_uris']:
-                    if artist['uri'] == track_object_uri:
-
-                        # Add the genres from sp.artists() artist data to the track_list object genres property
-                        track_object['genres'].extend(artist['genres'])
-
-                        # Remove duplicate genres, for if one artist appears in multiple tracks in track_list
-                        track_object_genres_set = set(track_object['genres'])
-                        track_object['genres'] = list(track_object_genres_set)
-        offset += 50
+    if stats != None:
+        api_calls_without_dedup = -(-artist_uri_count // 50)
+        stats['artist_uris'] = artist_uri_count
+        stats['unique_artist_uris'] = len(artist_uris)
+        stats.update(lookup_stats)
+        stats['artist_api_calls_saved'] = api_calls_without_dedup - lookup_stats['artist_api_calls']
 
     return track_list
 
@@ -356,6 +676,7 @@ def create_genres_list(track_list):
 
 
 
+@metrics.timed_stage('genre_score_deduction')
 def genre_score_deduction(genre_input, track_list):
     '''
     Deduces the value of the "score" property on each track based on whether any of the user's requested genres 
@@ -369,21 +690,23 @@ def genre_score_deduction(genre_input, track_list):
         track_list, updated with the "score" property adjusted.
     '''
 
-    for track in track_list:
+    # Intern each track's genres into a bitmask and compile the user's selection into one mask, so matching a
+    # track is a single AND instead of a list membership check per selected genre
+    genre_ids, track_masks = scoring.build_genre_index(track_list)
+    genre_mask = scoring.compile_genre_mask(genre_input, genre_ids)
 
-        # If any genre(s) of that track match what what the user requested, saved in genre_input, do nothing
-        if any(genre in track['genres'] for genre in genre_input):
-            continue
-
-        # If there is not a match, deduce 20 points from the score
-        else:
-            track['score'] -= 20
+    # If any genre(s) of a track match what the user requested, saved in genre_input, its score is unchanged.
+    # If there is not a match, 20 points are deduced from the score
+    new_scores = scoring.genre_deductions([track['score'] for track in track_list], track_masks, genre_mask)
+    for track, new_score in zip(track_list, new_scores):
+        track['score'] = new_score
 
     return track_list
 
 
 
 
+@metrics.timed_stage('feature_score_deduction')
 def feature_score_deduction(input_values, track_list):
     '''
     Deduces the value of the "score" property on each track based on the delta between the rating of each feature
@@ -400,78 +723,160 @@ def feature_score_deduction(input_values, track_list):
         track_list, updated with the "score" property adjusted.
     '''
 
-    # For each track...
-    for track in track_list:
+    # Only the audio features the user submitted are scored, in the order they were submitted
+    feature_names = [feature_name for feature_name in input_values if feature_name in AUDIO_FEATURES]
+    user_values = [float(input_values[feature_name]) for feature_name in feature_names]
+
+    # Pack the features of all tracks into one matrix and compute every deduction in one pass
+    feature_matrix = scoring.build_feature_matrix(track_list, feature_names)
+    new_scores = scoring.feature_deductions([track['score'] for track in track_list], feature_matrix, user_values)
+
+    for track, new_score in zip(track_list, new_scores):
+        track['score'] = float(new_score)
+
+    return track_list
+
+
 
-        # Get one feature and user input value from input values...
-        for feature_name, user_score in input_values.items():
 
-            # Then find a match in the track properties...
-            for track_property_name, track_feature_value in track.items():
+@metrics.timed_stage('update_score_components')
+def update_score_components(score_components, track_list, genre_input=None, input_values=None):
+    '''
+    Keeps each track's score as separate components (the base score in track["score"], a genre deduction
+    and an audio features deduction) instead of subtracting from track["score"] in place. Each deduction
+    vector is recomputed only when its input changes (or was invalidated), so submitting the same genres or
+    feature values again doesn't stack deductions.
+
+    Args:
+        score_components: The score components from the Flask session, or None to start fresh.
+        track_list: The track_list object from the Flask session.
+        genre_input: Optional list of genres the user selected on genres.html
+        input_values: Optional int values pulled from each range element on features.html.
+
+    Returns:
+        The updated score components: a dictionary of genre_input, genre, input_values and features, where 
+        genre and features are deduction vectors packed with scoring.pack_vector.
+    '''
 
-                # When the match is found...
-                if feature_name == track_property_name:
+    components = {'genre_input': None, 'genre': None, 'input_values': None, 'features': None}
+    components.update(score_components or {})
 
-                    # Validate that the track feature has a value...
-                    if track_feature_value != None:
+    # A changed input invalidates its deduction vector
+    if genre_input != None and genre_input != components['genre_input']:
+        components['genre_input'] = list(genre_input)
+        components['genre'] = None
+    if input_values != None and input_values != components['input_values']:
+        components['input_values'] = dict(input_values)
+        components['features'] = None
 
-                        # Then convert the user score to a float and deduce points from the track['score'] as necessary
-                        user_score_float = float(user_score)
-                        track_feature_value_normalized = track_feature_value * 100
-                        value_difference = abs(track_feature_value_normalized - user_score_float)
-                        if value_difference == 0:
-                            continue
-                        else:
-                            dissimilarity_percentage = value_difference / 100
-                            track['score'] -= 10 * dissimilarity_percentage
+    # Recompute only the invalidated deduction vectors that have an input
+    if components['genre_input'] != None and components['genre'] == None:
+        deductions = scoring.genre_deduction_vector(track_list, components['genre_input'])
+        components['genre'] = scoring.pack_vector(deductions)
+
+    if components['input_values'] != None and components['features'] == None:
+        feature_names = [name for name in components['input_values'] if name in AUDIO_FEATURES]
+        user_values = [float(components['input_values'][name]) for name in feature_names]
+        feature_matrix = scoring.build_feature_matrix(track_list, feature_names)
+        deductions = scoring.feature_deduction_vector(feature_matrix, user_values)
+        components['features'] = scoring.pack_vector(deductions)
+
+    return components
+
+
+
+
+def apply_score_components(score_components, track_list):
+    '''
+    Sets the "score" property of each track to its final score: the base score minus the genre and audio
+    features deductions in score_components. Use a track_list fresh from the session, since track["score"]
+    is read as the base score.
+
+    Args:
+        score_components: The score components returned by update_score_components.
+        track_list: The track_list object from the Flask session.
+
+    Returns:
+        track_list, updated with the final "score" property.
+    '''
+
+    deduction_vectors = [
+        scoring.unpack_vector(score_components[name]) for name in ['genre', 'features']
+        if score_components != None and score_components.get(name) != None
+    ]
+    final_scores = scoring.combine_scores([track['score'] for track in track_list], *deduction_vectors)
+    for track, final_score in zip(track_list, final_scores):
+        track['score'] = final_score
 
     return track_list
 
 
 
 
-def get_album_art(top_30_tracks, sp):
+@metrics.timed_stage('get_album_art')
+def get_album_art(top_30_tracks, sp, catalog=CATALOG):
     '''
-    Gets and sets the album art for each track.
+    Gets and sets the album art for each track. Album art is normally captured when the track objects are 
+    created, so this only looks up the tracks that are missing it: first in catalog, then 50 at a time with 
+    Spotipy's tracks method.
 
     Args:
         top_30_tracks: A list containing 30 track objects.
         sp: The Spotipy object used for accessing Spotipy methods.
+        catalog: The track catalog, or None to always use the Spotify API.
 
     Returns:
         top_30_tracks, updated with album art URLs.
     '''
 
-    for track in top_30_tracks:
-        album = sp.track(track["track_id"])
-        track["album_art"] = album['album']['images'][0]['url']
+    # Tracks created before album art was captured at ingest won't have it yet
+    missing_tracks = [track for track in top_30_tracks if track.get('album_art') == None]
+    missing_ids = list(dict.fromkeys(track['track_id'] for track in missing_tracks))
+
+    album_art_by_id = {}
+    if catalog != None and missing_ids:
+        for track_id, record in catalog.get_tracks(missing_ids).items():
+            if record['album_art'] != None:
+                album_art_by_id[track_id] = record['album_art']
+        missing_ids = [track_id for track_id in missing_ids if track_id not in album_art_by_id]
+
+    # sp.tracks has an upper limit of 50 track ids it can accept, so loop through the misses in groups of 50
+    fetched_tracks = []
+    for offset in range(0, len(missing_ids), 50):
+        tracks_results = sp.tracks(missing_ids[offset:offset+50])
+        for track in tracks_results['tracks']:
+            if track != None:
+                album_art_by_id[track['id']] = get_album_art_url(track)
+                fetched_tracks.append(create_track_object(track))
+
+    if catalog != None and fetched_tracks:
+        catalog.upsert_tracks(fetched_tracks)
+
+    for track in missing_tracks:
+        track['album_art'] = album_art_by_id.get(track['track_id'])
 
     return top_30_tracks
 
 
 
 
-def get_final_playlist(track_list, sp):
+@metrics.timed_stage('get_final_playlist')
+def get_final_playlist(track_list, sp, playlist_size=PLAYLIST_SIZE):
     '''
-    Gets the final playlist of 30 tracks.
+    Gets the final playlist of 30 tracks (or playlist_size tracks).
 
     Args:
         track_list: The track_list object from the Flask session.
         sp: The Spotipy object used for accessing Spotipy methods.
+        playlist_size: The number of tracks in the playlist.
 
     Returns:
         top_30_tracks_with_album_art
     '''
 
-    # Use sorted() with a lambda function to sort all list objects based on the track's score, starting
-    # with the highest score
-    sorted_track_list = sorted(track_list, key=lambda track: track['score'], reverse=True)
-
-    # Instantiate list for top 30
-    top_30_tracks = []
-
-    # Returns the first 30 in the list, i.e., the 30 tracks with the highest scores
-    top_30_tracks = sorted_track_list[:30] 
+    # Select the tracks with the highest scores using a heap rather than sorting the whole list. Ties keep 
+    # their order in track_list, the same as a stable sort would
+    top_30_tracks = scoring.select_top_tracks(track_list, playlist_size)
 
     # Invoke get_album_art to get and set album art on the top 30 tracks for rendering in playlist.html
     top_30_tracks_with_album_art = get_album_art(top_30_tracks, sp)
@@ -486,6 +891,7 @@ def get_final_playlist(track_list, sp):
 
 
 
+@metrics.timed_stage('create_new_playlist')
 def create_new_playlist(playlist, sp, playlist_name):
     '''
     Creates the new playlist in Spotify. Spotipy does this with the user_playlist_create() method to create
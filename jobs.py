@@ -0,0 +1,388 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------JOBS------------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Number of background jobs run at the same time, across all users
+JOB_WORKERS = 4
+
+# Number of jobs a user is waiting on (e.g., streaming in their top tracks) run at the same time, in a pool of
+# their own so they never queue behind the bulk jobs above
+INTERACTIVE_JOB_WORKERS = 32
+
+# Seconds a job's progress is kept after it was last updated
+PROGRESS_TTL = 60 * 60
+
+# Seconds a finished job (and its result) is kept for its key to pick up before it is dropped, so the jobs of
+# users who leave don't stay in memory for the life of the process
+FINISHED_JOB_TTL = 10 * 60
+
+# Failed jobs are logged here, since callers only get None from Job.result()
+logger = logging.getLogger(__name__)
+
+
+
+
+class MemoryProgressStore:
+    '''
+    Keeps job progress in this process. Progress can only be polled from the process running the job.
+
+    Args:
+        ttl: Seconds a job's progress is kept after it was last updated.
+    '''
+
+    def __init__(self, ttl=PROGRESS_TTL):
+        self.ttl = ttl
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def save(self, job_id, progress):
+        now = time.time()
+        with self._lock:
+            self._progress[job_id] = (dict(progress), now + self.ttl)
+
+            # Drop progress that has expired
+            for expired_id in [key for key, (_, expires_at) in self._progress.items() if expires_at <= now]:
+                del self._progress[expired_id]
+
+    def load(self, job_id):
+        with self._lock:
+            entry = self._progress.get(job_id)
+        if entry == None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+
+
+
+class RedisProgressStore:
+    '''
+    Keeps job progress in Redis, or a local Redis-compatible server, so it can be polled from any process.
+    Requires the redis library (pip install redis).
+
+    Args:
+        url: The Redis URL, e.g., redis://localhost:6379/0
+        ttl: Seconds a job's progress is kept after it was last updated.
+    '''
+
+    def __init__(self, url, ttl=PROGRESS_TTL):
+        import redis
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+
+    def save(self, job_id, progress):
+        self._redis.set(f"job_progress:{job_id}", json.dumps(progress), ex=self.ttl)
+
+    def load(self, job_id):
+        progress = self._redis.get(f"job_progress:{job_id}")
+        if progress == None:
+            return None
+        return json.loads(progress)
+
+
+
+
+class JobCancelled(Exception):
+    '''
+    Raised inside a job's function when the job has been cancelled.
+    '''
+
+
+
+
+class Job:
+    '''
+    Handle for one background job. The job's function receives this handle as its first argument, and should
+    call raise_if_cancelled() between stages so a cancelled job stops early.
+
+    Jobs also report their progress (stage, Spotify API calls made and items, e.g., tracks, streamed in so far)
+    through set_stage(), add_api_calls() and add_items(), which is saved to the progress store for polling.
+    Part of the result can be handed to other jobs before the job is done through set_partial_result().
+
+    Args:
+        key: The key the job was submitted under, e.g., the user's client key.
+        store: The progress store the job's progress is saved to.
+    '''
+
+    def __init__(self, key, store):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.future = None
+        self.store = store
+        self.progress = {
+            'status': 'queued',
+            'stage': None,
+            'api_calls': 0,
+            'api_calls_expected': None,
+            'items': 0,
+            'elapsed_seconds': 0.0,
+            'eta_seconds': None
+        }
+        self._started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._partial_result = None
+        self._partial_result_ready = threading.Event()
+        self._progress_lock = threading.Lock()
+        self.store.save(self.id, self.progress)
+
+    def _update_progress(self, **changes):
+        with self._progress_lock:
+            self.progress.update(changes)
+            if self._started_at != None:
+                elapsed = time.time() - self._started_at
+                self.progress['elapsed_seconds'] = round(elapsed, 2)
+
+                # Estimate the time left from the rate of API calls so far
+                api_calls = self.progress['api_calls']
+                api_calls_expected = self.progress['api_calls_expected']
+                if self.progress['status'] == 'running' and api_calls > 0 and api_calls_expected != None:
+                    remaining = max(api_calls_expected - api_calls, 0)
+                    self.progress['eta_seconds'] = round(elapsed / api_calls * remaining, 2)
+            self.store.save(self.id, self.progress)
+
+    def set_stage(self, stage, api_calls_expected=None):
+        '''
+        Reports the stage the job is in.
+
+        Args:
+            stage: A short name for the stage, e.g., "recommendations".
+            api_calls_expected: Optional estimate of the total API calls the job will make, used for the ETA.
+
+        Returns:
+            None
+        '''
+
+        changes = {'stage': stage}
+        if api_calls_expected != None:
+            changes['api_calls_expected'] = api_calls_expected
+        self._update_progress(**changes)
+
+    def add_api_calls(self, count=1):
+        with self._progress_lock:
+            api_calls = self.progress['api_calls'] + count
+        self._update_progress(api_calls=api_calls)
+
+    def add_items(self, count=1):
+        with self._progress_lock:
+            items = self.progress['items'] + count
+        self._update_progress(items=items)
+
+    def _run(self, function, *args, **kwargs):
+
+        # Cancelled after the executor picked the job up, when future.cancel() can no longer mark it
+        if self.cancelled():
+            self._update_progress(status='cancelled')
+            raise JobCancelled()
+        self._started_at = time.time()
+        self._update_progress(status='running')
+        try:
+            result = function(self, *args, **kwargs)
+        except JobCancelled:
+            self._update_progress(status='cancelled')
+            raise
+        except Exception:
+            logger.exception("Job %s (%s) failed", self.id, self.key)
+            self._update_progress(status='failed')
+            raise
+        self._update_progress(status='done', eta_seconds=0.0)
+        return result
+
+    def _finished(self, future):
+        self.finished_at = time.time()
+
+        # Wake anything still waiting on a partial result the job never set
+        self._partial_result_ready.set()
+
+    def set_partial_result(self, value):
+        '''
+        Hands part of the job's result to other code before the job is done, e.g., the top tracks before their
+        genres and audio features are set.
+
+        Args:
+            value: The partial result. It is shared, not copied, so the job shouldn't change it afterwards in ways
+                its readers would notice.
+
+        Returns:
+            None
+        '''
+
+        self._partial_result = value
+        self._partial_result_ready.set()
+
+    def partial_result(self, timeout=None):
+        '''
+        Waits for the job's partial result.
+
+        Args:
+            timeout: The most seconds to wait, or None to wait until it is set or the job finishes.
+
+        Returns:
+            The value passed to set_partial_result(), or None if the job finished (e.g., failed or was cancelled)
+            without setting one.
+        '''
+
+        self._partial_result_ready.wait(timeout)
+        return self._partial_result
+
+    def cancel(self):
+        '''
+        Cancels the job. A job that hasn't started won't run; a running job stops at its next
+        raise_if_cancelled() check.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+        self._cancel_event.set()
+        if self.future != None and self.future.cancel():
+            self._update_progress(status='cancelled')
+
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled():
+            raise JobCancelled()
+
+    def done(self):
+        return self.future != None and self.future.done()
+
+    def result(self, timeout=None):
+        '''
+        Waits for the job to finish and returns its result.
+
+        Args:
+            timeout: The most seconds to wait, or None to wait until the job finishes.
+
+        Returns:
+            The return value of the job's function, or None if the job was cancelled or failed. Failures are
+            logged when they happen.
+        '''
+
+        try:
+            return self.future.result(timeout=timeout)
+        except Exception:
+            return None
+
+
+
+
+class JobManager:
+    '''
+    Runs background jobs on a shared worker pool, keeping at most one job per key. Submitting a new job for a
+    key cancels the key's previous job. Finished jobs that nobody picks up are dropped after finished_ttl.
+
+    Args:
+        max_workers: The number of jobs run at the same time.
+        store: Where job progress is kept. Defaults to a MemoryProgressStore.
+        finished_ttl: Seconds a finished job is kept before it is dropped.
+    '''
+
+    def __init__(self, max_workers=JOB_WORKERS, store=None, finished_ttl=FINISHED_JOB_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.store = store if store != None else MemoryProgressStore()
+        self.finished_ttl = finished_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _drop_expired(self):
+
+        # Called with the lock held. Finished jobs whose keys never came back for them are dropped
+        expires_before = time.time() - self.finished_ttl
+        for key in [
+            key for key, job in self._jobs.items() if job.finished_at != None and job.finished_at <= expires_before
+        ]:
+            del self._jobs[key]
+
+    def submit(self, key, function, *args, **kwargs):
+        '''
+        Starts a background job. The function is called as function(job, *args, **kwargs).
+
+        Args:
+            key: The key the job is stored under, e.g., the user's client key.
+            function: The function to run.
+            *args: Positional arguments passed to function after the job handle.
+            **kwargs: Keyword arguments passed to function.
+
+        Returns:
+            The Job handle.
+        '''
+
+        job = Job(key, self.store)
+        with self._lock:
+            self._drop_expired()
+            previous = self._jobs.get(key)
+            if previous != None:
+                previous.cancel()
+            self._jobs[key] = job
+        job.future = self._executor.submit(job._run, function, *args, **kwargs)
+        job.future.add_done_callback(job._finished)
+        return job
+
+    def get(self, key):
+        with self._lock:
+            self._drop_expired()
+            return self._jobs.get(key)
+
+    def progress(self, job_id):
+        '''
+        Gets a job's progress from the progress store.
+
+        Args:
+            job_id: The job's id.
+
+        Returns:
+            A dictionary with the job's status, stage, api_calls, api_calls_expected, items, elapsed_seconds
+            and eta_seconds, or None if the job is unknown or its progress expired.
+        '''
+
+        return self.store.load(job_id)
+
+    def pop(self, key):
+        '''
+        Removes a key's job so its result can be handed off to the caller.
+
+        Args:
+            key: The key the job was submitted under.
+
+        Returns:
+            The Job handle, or None if the key has no job.
+        '''
+
+        with self._lock:
+            return self._jobs.pop(key, None)
+
+    def cancel(self, key):
+        '''
+        Cancels and removes a key's job, if it has one.
+
+        Args:
+            key: The key the job was submitted under.
+
+        Returns:
+            None
+        '''
+
+        job = self.pop(key)
+        if job != None:
+            job.cancel()
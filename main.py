@@ -1,12 +1,22 @@
-import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-from flask import Flask, request, url_for, session, redirect, render_template, flash
+from flask import Flask, request, url_for, session, redirect, render_template, flash, jsonify, g, Response
 from flask_session import Session
+import atexit
 import time
 from datetime import datetime
+import json
 import os
+import uuid
 from dotenv import load_dotenv
 import helper_functions as helpers
+import track_codec
+import pipeline
+import jobs
+import spotify_clients
+import ranking
+import scoring
+import metrics
+import rate_limiter
 
 # To get CLIENT_ID and CLIENT_SECRET from .env file
 load_dotenv()
@@ -32,7 +42,67 @@ app.secret_key = "lk3j24h25iojflasdjk9fjio"
 app.config['SESSION_COOKIE_NAME'] = "Playlist Maker Cookie"
 app.config['SESSION_TYPE'] = 'filesystem' # for flask_session
 app.config['SECRET_KEY'] = 'asdflksdfljkwefhbn2354g'
+app.config['TOP_TRACKS_MAX_WORKERS'] = helpers.TOP_TRACKS_MAX_WORKERS # concurrent top tracks pages
+app.config['RECOMMENDATIONS_MAX_WORKERS'] = helpers.RECOMMENDATIONS_MAX_WORKERS # concurrent recommendations
+app.config['PLAYLIST_SIZE'] = helpers.PLAYLIST_SIZE # tracks in the final playlist
+app.config['PREFETCH_NEW_TRACKS'] = False # also prefetch new tracks while the user picks new or familiar
+app.config['INTERACTIVE_JOB_WORKERS'] = jobs.INTERACTIVE_JOB_WORKERS # concurrent jobs users are waiting on, e.g., the prefetch
+app.config['JOB_PROGRESS_REDIS_URL'] = os.getenv('JOB_PROGRESS_REDIS_URL') # optional Redis for job progress
+app.config['JOB_EVENTS_INTERVAL'] = 0.25 # seconds between progress checks when streaming a job's progress
+app.config['JOB_EVENTS_MAX_SECONDS'] = 30 # longest a job's progress is streamed before the page falls back to polling
+app.config['SPOTIFY_POOL_SIZE'] = spotify_clients.POOL_SIZE # keep-alive connections to the Spotify API
+app.config['SPOTIFY_HOST_CONCURRENCY'] = spotify_clients.HOST_CONCURRENCY # concurrent requests to the Spotify API
+app.config['SPOTIFY_MAX_RETRIES'] = spotify_clients.MAX_RETRIES # retries for 429 and 5xx responses
+app.config['SPOTIFY_MAX_RETRY_WAIT'] = spotify_clients.MAX_RETRY_WAIT # longest wait in seconds before a retry, even if Retry-After asks for more
+app.config['SPOTIFY_RATE_LIMIT'] = float(os.getenv('SPOTIFY_RATE_LIMIT', 0)) # Spotify calls per second across all users, 0 for no limit
+app.config['SPOTIFY_RATE_BURST'] = int(os.getenv('SPOTIFY_RATE_BURST', rate_limiter.BURST)) # Spotify calls allowed at once after a quiet period
+app.config['SPOTIFY_RATE_LIMIT_FILE'] = os.getenv('SPOTIFY_RATE_LIMIT_FILE') # optional file sharing the rate across processes
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED') == '1' # measure Spotify calls and helper stages
+app.config['TRACE_LOG'] = os.getenv('TRACE_LOG') == '1' # log each request's Spotify calls and stages
 TOKEN_INFO = "token_info"
+CLIENT_KEY = "client_key"
+
+# Per-process pool of Spotipy objects, one per user, sharing one pooled HTTP transport. Only the token is kept 
+# in the session
+client_pool = spotify_clients.SpotifyClientPool(
+    http_session=spotify_clients.create_http_session(
+        pool_size=app.config['SPOTIFY_POOL_SIZE'],
+        host_concurrency=app.config['SPOTIFY_HOST_CONCURRENCY'],
+        max_retries=app.config['SPOTIFY_MAX_RETRIES'],
+        max_wait=app.config['SPOTIFY_MAX_RETRY_WAIT']
+    )
+)
+
+# The shared connections are only closed when the process exits, never when a single client is dropped
+atexit.register(client_pool.close)
+
+# Background jobs, e.g., preparing new tracks. The prefetch of a user's top tracks while they are on 
+# newOrFamiliar.html is on the path to every page after it, so it runs in a larger pool of its own instead of
+# queueing behind those. Job progress (of both pools) is kept in this process unless a Redis URL is configured
+if app.config['JOB_PROGRESS_REDIS_URL']:
+    job_progress = jobs.RedisProgressStore(app.config['JOB_PROGRESS_REDIS_URL'])
+else:
+    job_progress = jobs.MemoryProgressStore()
+background_jobs = jobs.JobManager(store=job_progress)
+interactive_jobs = jobs.JobManager(max_workers=app.config['INTERACTIVE_JOB_WORKERS'], store=job_progress)
+
+# Per-process feature matrices for re-ranking tracks while the user drags the sliders on features.html
+rankings = ranking.RankingCache()
+
+# If a rate limit is set, Spotify calls (and their retries) from every user take turns through one token 
+# bucket, with interactive calls first. The bucket is shared with other processes through a file if one is 
+# configured. Without a limit, 429s are only handled by the transport's retries; interactive calls still get 
+# the transport's host slots first either way
+spotify_scheduler = None
+if app.config['SPOTIFY_RATE_LIMIT'] > 0:
+    spotify_scheduler = rate_limiter.TokenBucketScheduler(
+        rate=app.config['SPOTIFY_RATE_LIMIT'],
+        burst=app.config['SPOTIFY_RATE_BURST'],
+        shared_path=app.config['SPOTIFY_RATE_LIMIT_FILE']
+    )
+
+# Spotify calls and helper stages are only measured when metrics are enabled, and served on /metrics
+metrics.enable(app.config['METRICS_ENABLED'] or app.config['TRACE_LOG'])
 
 # Instantiate flask_session library
 Session(app)
@@ -80,11 +150,90 @@ def get_token():
     if is_expired:
         sp_oauth = create_spotify_oauth()
         token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
+        session[TOKEN_INFO] = token_info
     return token_info
 
 
 
 
+def get_spotify(priority=rate_limiter.INTERACTIVE):
+    '''
+    Gets the current user's Spotipy object from the client pool, rebuilding it from the session's token if
+    needed. The Spotipy object itself is never stored in the session. Every call made with it has the given
+    priority, and if a rate limit is set, waits its turn with the rate limiter shared by all users.
+
+    Args:
+        priority: rate_limiter.INTERACTIVE for calls the user is waiting on, or rate_limiter.BULK for
+            background jobs.
+
+    Returns:
+        The Spotipy object used for accessing Spotipy methods.
+    '''
+    token_info = get_token()
+    if CLIENT_KEY not in session:
+        session[CLIENT_KEY] = uuid.uuid4().hex
+    sp = client_pool.get(session[CLIENT_KEY], token_info['access_token'])
+
+    # Measure every Spotify call made with this object, adding them to the request's trace if there is one
+    if metrics.ENABLED:
+        sp = metrics.InstrumentedSpotify(sp, trace=metrics.current_trace.get())
+    return rate_limiter.RateLimitedSpotify(sp, spotify_scheduler, session[CLIENT_KEY], priority)
+
+
+
+
+def job_key(name):
+    '''
+    Gets the key the current user's background job of a given kind is stored under.
+
+    Args:
+        name: The kind of job, e.g., "prefetch" or "new-tracks".
+
+    Returns:
+        The job key.
+    '''
+    return f"{name}:{session.get(CLIENT_KEY)}"
+
+
+
+
+def load_track_list():
+    '''
+    Loads track_list from the Flask session, unpacking it from the compact format it is stored in.
+
+    Args:
+        None
+
+    Returns:
+        track_list, as a list of track objects.
+    '''
+    return track_codec.unpack_track_list(session.get('track_list'))
+
+
+
+
+def save_track_list(track_list):
+    '''
+    Saves track_list to the Flask session in a compact format, which keeps the session files small. The
+    cached genre and audio features deductions no longer line up with the saved tracks, so they are dropped
+    and recomputed from the user's saved inputs when next needed.
+
+    Args:
+        track_list: A list of track objects.
+
+    Returns:
+        None
+    '''
+    session['track_list'] = track_codec.pack_track_list(track_list)
+    session['track_list_version'] = uuid.uuid4().hex
+
+    score_components = session.get('score_components')
+    if score_components != None:
+        session['score_components'] = dict(score_components, genre=None, features=None)
+
+
+
+
 
 
 # [---------------------------------------------------------------]
@@ -96,6 +245,72 @@ def get_token():
 
 
 
+
+@app.before_request
+def start_request_metrics():
+    '''
+    Starts timing the request and, if trace logging is on, starts the request's trace.
+
+    Args:
+        None
+
+    Returns:
+        None
+    '''
+    if metrics.ENABLED:
+        g.request_started_at = time.perf_counter()
+    if app.config['TRACE_LOG']:
+        g.trace = metrics.Trace()
+        g.trace_token = metrics.current_trace.set(g.trace)
+
+
+
+
+@app.after_request
+def finish_request_metrics(response):
+    '''
+    Records how long the request took and, if trace logging is on, logs the request's trace.
+
+    Args:
+        response: The response being returned.
+
+    Returns:
+        The response, unchanged.
+    '''
+    if metrics.ENABLED and 'request_started_at' in g:
+        metrics.registry.observe(
+            'request_duration_seconds', {'route': request.endpoint or 'unknown'},
+            time.perf_counter() - g.request_started_at
+        )
+    if app.config['TRACE_LOG'] and 'trace' in g:
+        app.logger.info("trace %s %s: %s", request.method, request.path, g.trace.summary())
+        metrics.current_trace.reset(g.trace_token)
+    return response
+
+
+
+
+@app.route("/metrics")
+def metrics_page():
+    '''
+    Returns the Spotify call counts, latency and batch size histograms, helper stage timings and route
+    timings in the Prometheus text format.
+
+    Args:
+        None
+
+    Returns:
+        The metrics as text, or a 404 if metrics are disabled.
+    '''
+    if not metrics.ENABLED:
+        return Response("metrics are disabled\n", status=404, mimetype='text/plain')
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+
+
+
+
 @app.route("/")
 def home_page():
     '''
@@ -128,7 +343,12 @@ def redirect_page():
     '''
     sp_oauth = create_spotify_oauth()
 
-    # Clears out session data from a previous use of the app
+    # Clears out session data from a previous use of the app, including the user's pooled Spotipy object, 
+    # prepared ranking and any prefetch still running for them
+    client_pool.remove(session.get(CLIENT_KEY))
+    rankings.remove(session.get(CLIENT_KEY))
+    interactive_jobs.cancel(job_key('prefetch'))
+    background_jobs.cancel(job_key('new-tracks'))
     session.clear()
 
     # Gets the authorization code from the redirect URL
@@ -158,9 +378,9 @@ def new_or_familiar_page():
 
     # Try to validate or refresh the access token
     try:
-        token_info = get_token()
+        get_token()
     except:
-        redirect(url_for('home_page', _external=False))
+        return redirect(url_for('home_page', _external=False))
 
     if request.method == "POST":
 
@@ -169,25 +389,26 @@ def new_or_familiar_page():
         return redirect(url_for('genres_page', new_or_familiar = new_or_familiar))
 
     # GET
-    # Create a reference to the Spotipy library with the access token
-    sp = spotipy.Spotify(auth=token_info['access_token'])
-    session['sp'] = sp
-
-    # Instantiate track_list to later build and save in session
-    track_list = []
-
-    # Looper offset for iterating over user's top tracks
-    looper_offset = 0
-
-    # Get top 500 tracks
-    for i in range(10):
-        new_tracks = helpers.get_top_tracks(looper_offset, sp)
-        track_list.extend(new_tracks)
-        looper_offset += 50
-
-    # Save track_list to session
-    session['track_list'] = track_list
-    return render_template("newOrFamiliar.html")
+    # Genres and audio features picked on an earlier visit don't carry over. The top tracks are streamed in 
+    # below, and saved to the session by genres_page once they're all in
+    session.pop('score_components', None)
+    session.pop('track_list', None)
+    session['audio_features_ready'] = False
+
+    # New tracks prepared from an earlier visit's top tracks are out of date
+    background_jobs.cancel(job_key('new-tracks'))
+
+    # Stream in the top 500 tracks in the background, getting the genres and audio features of each page as 
+    # it arrives, so the page renders right away instead of waiting for every page. newOrFamiliar.html shows 
+    # the job's progress from job_events_page. This replaces (and cancels) any prefetch from an earlier visit.
+    # The user is waiting on these calls, so they are made at interactive priority
+    sp = get_spotify()
+    prefetch_job = interactive_jobs.submit(
+        job_key('prefetch'), pipeline.prefetch_track_lists, None, sp,
+        prefetch_new=app.config['PREFETCH_NEW_TRACKS'], concurrency=app.config['RECOMMENDATIONS_MAX_WORKERS'],
+        top_tracks_workers=app.config['TOP_TRACKS_MAX_WORKERS']
+    )
+    return render_template("newOrFamiliar.html", job_id=prefetch_job.id)
 
 
 
@@ -209,29 +430,69 @@ def genres_page(new_or_familiar):
     if request.method == "POST":
         user_input = request.form.getlist('genres')
 
-        # Invokes genre_score_deduction to deduct points from each track object's "score" property
-        track_list_updated_score_genres = helpers.genre_score_deduction(user_input, session.get('track_list'))
-
-        # Update session's track_list
-        session.update({'track_list': track_list_updated_score_genres})
+        # Recompute the genre deduction of each track. Only this score component is saved to the session; 
+        # track_list itself is unchanged, so submitting again (e.g., after going back) doesn't stack deductions
+        session['score_components'] = helpers.update_score_components(
+            session.get('score_components'), load_track_list(), genre_input=user_input
+        )
         return redirect(url_for("features_page"))
      
     # GET
-    if new_or_familiar == 'new':
-
-        # Reset track_list to new tracks, store in session's track_list
-        novel_track_list = helpers.get_new_tracks(session.get("track_list"), session.get("sp"))
-        session.update({'track_list': novel_track_list})
+    sp = get_spotify()
+
+    # Counters filled in by set_artist_genres
+    genre_stats = {}
+
+    # Take over the prefetch started by new_or_familiar_page, which streams in the top tracks that both choices
+    # need. For "familiar" (or "new" if it is prefetched too), this page renders loading.html while it is 
+    # running, which shows the job's progress and reloads this page once it is done
+    prefetched = {}
+    prefetch_job = interactive_jobs.get(job_key('prefetch'))
+    if prefetch_job != None and (new_or_familiar == 'familiar' or app.config['PREFETCH_NEW_TRACKS']):
+        if not prefetch_job.done():
+            return render_template("loading.html", job_id=prefetch_job.id, new_or_familiar=new_or_familiar)
+        interactive_jobs.pop(job_key('prefetch'))
+        prefetched = prefetch_job.result() or {}
+
+    # For "new" without a prefetch, replacing track_list with new tracks takes about 100 recommendations calls,
+    # so it runs as a background job. It starts from the prefetch's top tracks as soon as they have streamed 
+    # in, without waiting for their genres and audio features, which "new" doesn't use. If the prefetch failed,
+    # it gets the top tracks itself. This page renders loading.html, which shows the job's progress and 
+    # reloads this page once the job is done
+    new_tracks_result = None
+    if new_or_familiar == 'new' and new_or_familiar not in prefetched:
+        new_tracks_job = background_jobs.get(job_key('new-tracks'))
+        if new_tracks_job == None:
+            new_tracks_job = background_jobs.submit(
+                job_key('new-tracks'), pipeline.prepare_new_tracks_job, load_track_list(),
+                get_spotify(priority=rate_limiter.BULK), top_tracks_job=prefetch_job,
+                concurrency=app.config['RECOMMENDATIONS_MAX_WORKERS']
+            )
+        if not new_tracks_job.done():
+            return render_template("loading.html", job_id=new_tracks_job.id, new_or_familiar=new_or_familiar)
+        background_jobs.pop(job_key('new-tracks'))
+        new_tracks_result = new_tracks_job.result()
+
+    if new_or_familiar in prefetched:
+        track_list_with_genres, genre_stats = prefetched[new_or_familiar]
+    elif new_tracks_result != None:
+        track_list_with_genres, genre_stats = new_tracks_result
+
+    # No prefetch (or the new tracks job failed), so run the pipeline now: for "new", replaces track_list with 
+    # new tracks; then sets the genres and audio features of every track at the same time. "familiar" retains 
+    # the original track_list
+    else:
+        track_list_with_genres = pipeline.run(pipeline.prepare_track_list(
+            load_track_list(), sp, new_or_familiar, genre_stats=genre_stats,
+            concurrency=app.config['RECOMMENDATIONS_MAX_WORKERS']
+        ))
+    save_track_list(track_list_with_genres)
 
-        # Set artist genres in track_list
-        track_list_with_genres = helpers.set_artist_genres(session.get("track_list"), session.get("sp"))
-        session.update({"track_list": track_list_with_genres})
+    # Audio features are already set, so features_page doesn't need to get them again
+    session['audio_features_ready'] = True
 
-    if new_or_familiar == 'familiar':
-        
-        # Retain original track_list and set artist genres
-        track_list_with_genres = helpers.set_artist_genres(session.get("track_list"), session.get("sp"))
-        session.update({"track_list": track_list_with_genres})
+    # Log how many sp.artists calls were made, and how many were saved by only looking up each artist once
+    app.logger.info("set_artist_genres: %s", genre_stats)
 
     # Create genres list for genres_page rendering    
     genres_list = helpers.create_genres_list(track_list_with_genres)
@@ -240,6 +501,64 @@ def genres_page(new_or_familiar):
     
    
 
+@app.route("/jobs/<job_id>")
+def job_progress_page(job_id):
+    '''
+    Returns the progress of a background job as JSON, for loading.html (and newOrFamiliar.html once its event
+    stream ends) to poll.
+
+    Args:
+        job_id: The id of the job.
+
+    Returns:
+        The job's status, stage, api_calls, api_calls_expected, items, elapsed_seconds and eta_seconds as 
+        JSON, or a 404 if the job is unknown.
+    '''
+    progress = background_jobs.progress(job_id)
+    if progress == None:
+        return jsonify({'status': 'unknown'}), 404
+    return jsonify(progress)
+
+
+
+
+@app.route("/jobs/<job_id>/events")
+def job_events_page(job_id):
+    '''
+    Streams the progress of a background job as server-sent events, for newOrFamiliar.html. An event is sent
+    whenever the progress changes, and the stream ends once the job is no longer queued or running. Each stream
+    holds a worker, so it also ends after JOB_EVENTS_MAX_SECONDS; the page then polls job_progress_page instead.
+
+    Args:
+        job_id: The id of the job.
+
+    Returns:
+        A text/event-stream response. Each event's data is the job's progress as JSON (as returned by
+        job_progress_page), or {"status": "unknown"} if the job is unknown.
+    '''
+
+    interval = app.config['JOB_EVENTS_INTERVAL']
+    deadline = time.monotonic() + app.config['JOB_EVENTS_MAX_SECONDS']
+
+    def events():
+        last_progress = None
+        while time.monotonic() < deadline:
+            progress = background_jobs.progress(job_id) or {'status': 'unknown'}
+            if progress != last_progress:
+                last_progress = progress
+                yield f"data: {json.dumps(progress)}\n\n"
+            if progress['status'] not in ('queued', 'running'):
+                return
+            time.sleep(interval)
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # so proxies such as nginx pass each event on right away
+    })
+
+
+
+
 @app.route("/features", methods=["POST", "GET"])
 def features_page():
     '''
@@ -256,7 +575,7 @@ def features_page():
 
     if request.method == "POST":
 
-        # Instantiate user_features dict to supply to feature_score_deduction
+        # Instantiate user_features dict to supply to update_score_components
         user_features = {}
 
         # Get all user input and save to user_features dict
@@ -268,18 +587,67 @@ def features_page():
         user_features['speechiness'] = request.form.get('speechiness')
         user_features['valence'] = request.form.get('valence')
 
-        # Deduce each track's "score" based on user input using feature_score_deduction
-        track_list_features_deduced = helpers.feature_score_deduction(user_features, session.get("track_list"))
-
-        # Update track_list in session
-        session.update({'track_list': track_list_features_deduced})
+        # Recompute the audio features deduction of each track, saving only this score component to the session
+        session['score_components'] = helpers.update_score_components(
+            session.get('score_components'), load_track_list(), input_values=user_features
+        )
         return redirect(url_for("playlist_page"))
     
     # GET
-    # Set the audio features of each track
-    track_list_with_audio_features = helpers.get_audio_features(session.get("track_list"), session.get("sp"))
-    session.update({'track_list': track_list_with_audio_features})
-    return render_template("features.html")
+    # Set the audio features of each track, unless genres_page already did
+    if not session.get('audio_features_ready'):
+        track_list_with_audio_features = helpers.get_audio_features(load_track_list(), get_spotify())
+        save_track_list(track_list_with_audio_features)
+        session['audio_features_ready'] = True
+    return render_template("features.html", ranking_size=app.config['PLAYLIST_SIZE'])
+
+
+
+
+@app.route("/features/rank", methods=["POST"])
+def features_rank_page():
+    '''
+    Re-ranks the user's tracks against the slider values on features.html, for previewing the playlist while
+    the sliders are dragged. Ranks from feature matrices kept in memory, without any Spotify calls, and 
+    doesn't change the scores saved in the session.
+
+    Args:
+        None. The request body is JSON with the value (0-100) of each slider by audio feature name, and an
+        optional "k" for the number of tracks to return.
+
+    Returns:
+        The k highest scoring tracks as JSON, a 400 if a slider value isn't a number, or a 409 if the user has
+        no tracks to rank yet.
+    '''
+    body = request.get_json(silent=True) or {}
+    try:
+        input_values = {
+            feature_name: float(body[feature_name]) for feature_name in helpers.AUDIO_FEATURES if feature_name in body
+        }
+        k = int(body.get('k', app.config['PLAYLIST_SIZE']))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'slider values must be numbers'}), 400
+
+    # Nothing to rank until the user's tracks are loaded (e.g., the session expired)
+    if session.get('track_list') == None:
+        return jsonify({'error': 'no tracks loaded'}), 409
+
+    # The ranking is rebuilt from the session only when track_list or the genre selection changed
+    score_components = session.get('score_components') or {}
+    genre_input = score_components.get('genre_input')
+    version = (session.get('track_list_version'), tuple(genre_input) if genre_input != None else None)
+
+    def build():
+        track_list = load_track_list()
+        genre_deductions = None
+        if genre_input != None:
+            updated_components = helpers.update_score_components(score_components, track_list)
+            session['score_components'] = updated_components
+            genre_deductions = scoring.unpack_vector(updated_components['genre'])
+        return ranking.PreparedRanking(track_list, genre_deductions)
+
+    prepared_ranking = rankings.get(session.get(CLIENT_KEY), version, build)
+    return jsonify({'tracks': prepared_ranking.rank(input_values, k)})
 
 
 
@@ -314,8 +682,17 @@ def playlist_page():
         return redirect(url_for("create_playlist_page"))
     
     # GET
+    # Combine the base score and the genre and audio features deductions into each track's final score,
+    # first recomputing any deduction that was dropped because track_list changed
+    track_list = load_track_list()
+    score_components = helpers.update_score_components(session.get('score_components'), track_list)
+    session['score_components'] = score_components
+    track_list_scored = helpers.apply_score_components(score_components, track_list)
+
     # Returns the top 30 tracks, randomized for a more engaging listening experience
-    top_30_tracks = helpers.get_final_playlist(session.get("track_list"), session.get("sp"))
+    top_30_tracks = helpers.get_final_playlist(
+        track_list_scored, get_spotify(), playlist_size=app.config['PLAYLIST_SIZE']
+    )
     session["top_30_tracks"] = top_30_tracks
     return render_template("finalPlaylist.html", top_30_tracks=top_30_tracks)
 
@@ -340,7 +717,7 @@ def create_playlist_page():
         playlist_name = request.form.get('playlist_name')
 
         # Attempts to save to Spotify using create_new_playlist and saves the result to var success
-        success = helpers.create_new_playlist(session.get("top_30_tracks"), session.get("sp"), playlist_name)
+        success = helpers.create_new_playlist(session.get("top_30_tracks"), get_spotify(), playlist_name)
         result = ""
 
         # If successful, send to result_page for success message rendering
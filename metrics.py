@@ -0,0 +1,357 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from urllib.parse import urlsplit
+from spotipy.exceptions import SpotifyException
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [----------------------------METRICS----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Whether Spotify calls and helper stages are measured. Off by default; turned on with enable()
+ENABLED = False
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the batch size histogram buckets (IDs sent per Spotify call)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 20, 50, 100)
+
+# Help text for each metric in the /metrics output
+METRIC_HELP = {
+    'spotify_api_calls_total': "Spotify API calls made, by endpoint and final HTTP status (after retries).",
+    'spotify_http_responses_total': "HTTP responses received from the Spotify API, including those that were retried, by endpoint path and status.",
+    'spotify_api_call_duration_seconds': "Latency of Spotify API calls, by endpoint.",
+    'spotify_api_batch_size': "IDs (or items) requested per Spotify API call, by endpoint.",
+    'helper_stage_duration_seconds': "Time spent in each helper stage.",
+    'request_duration_seconds': "Time spent handling each Flask route.",
+    'rate_limit_wait_seconds': "Time Spotify API calls waited for the rate limiter, by priority.",
+    'spotify_coalesced_lookups_total': "IDs that joined a lookup already in flight instead of being requested again, by endpoint."
+}
+
+# The trace of the request being handled, if trace logging is on
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# The HTTP status of the last Spotify response received in this context, so InstrumentedSpotify records the
+# real status of calls that didn't raise
+last_response_status = contextvars.ContextVar('last_response_status', default=None)
+
+
+
+
+class Histogram:
+    '''
+    Counts observed values into cumulative buckets, Prometheus style, and keeps their sum and count.
+
+    Args:
+        buckets: The upper bound of each bucket, in increasing order.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+
+
+class MetricsRegistry:
+    '''
+    Keeps counters and histograms by name and label values, shared by all threads, and renders them in the
+    Prometheus text format.
+    '''
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram == None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        '''
+        Renders every metric in the Prometheus text exposition format.
+
+        Args:
+            None
+
+        Returns:
+            The metrics, as a string.
+        '''
+
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs]
+            return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+
+            described = set()
+            for (name, labels), value in counters:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{label_text(labels)} {value}")
+
+            for (name, labels), histogram in histograms:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+
+
+# Process-wide registry the /metrics route renders
+registry = MetricsRegistry()
+
+
+
+
+class Trace:
+    '''
+    The Spotify calls and helper stages of one Flask request, in the order they finished, for the per-request
+    trace log. Safe to add to from the helpers' worker threads.
+    '''
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, seconds, **fields):
+        event = {'kind': kind, 'name': name, 'ms': round(seconds * 1000, 2)}
+        event.update(fields)
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        '''
+        Summarizes the trace for logging.
+
+        Args:
+            None
+
+        Returns:
+            A dictionary of the request's total time, the number of Spotify calls, and every event.
+        '''
+
+        with self._lock:
+            events = list(self.events)
+        return {
+            'ms': round((time.perf_counter() - self.started_at) * 1000, 2),
+            'spotify_calls': len([event for event in events if event['kind'] == 'spotify']),
+            'events': events
+        }
+
+
+
+
+def enable(enabled=True):
+    '''
+    Turns measuring Spotify calls and helper stages on or off for the whole process.
+
+    Args:
+        enabled: Whether to measure.
+
+    Returns:
+        None
+    '''
+
+    global ENABLED
+    ENABLED = enabled
+
+
+
+
+def record_stage(name, seconds):
+    registry.observe('helper_stage_duration_seconds', {'stage': name}, seconds)
+    trace = current_trace.get()
+    if trace != None:
+        trace.add('stage', name, seconds)
+
+
+
+
+def endpoint_path(url):
+    '''
+    Finds the endpoint of a Spotify API URL for labeling responses: the first part of its path after the API
+    version, e.g., "artists" for /v1/artists/{id} or "me" for /v1/me/top/tracks, so IDs don't become labels.
+
+    Args:
+        url: The request URL, or just its path.
+
+    Returns:
+        The endpoint.
+    '''
+
+    parts = [part for part in urlsplit(url).path.split('/') if part]
+    if parts and parts[0] == 'v1':
+        parts = parts[1:]
+    return parts[0] if parts else ''
+
+
+
+
+def record_response(url, status):
+    '''
+    Counts one HTTP response from the Spotify API. Called by the transport (see spotify_clients) for every
+    response, including the rate limited and server error responses that are retried before Spotipy sees
+    them, so 429s are counted even when the retry succeeds.
+
+    Args:
+        url: The request URL, or just its path.
+        status: The HTTP status of the response.
+
+    Returns:
+        None
+    '''
+
+    if not ENABLED:
+        return
+    last_response_status.set(status)
+    registry.inc('spotify_http_responses_total', {'endpoint': endpoint_path(url), 'status': str(status)})
+
+
+
+
+def timed_stage(name):
+    '''
+    Decorator that times every call of a helper function as a stage. When metrics are disabled, the function
+    is called directly, so the only cost is one check.
+
+    Args:
+        name: The name of the stage, e.g., "get_audio_features".
+
+    Returns:
+        The decorator.
+    '''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_stage(name, time.perf_counter() - start)
+        return timed
+    return decorator
+
+
+
+
+def batch_size(args, kwargs):
+    '''
+    Finds the number of IDs (or items) sent in a Spotipy call: the length of its first list argument, or its
+    limit for calls that page through results.
+
+    Args:
+        args: The positional arguments of the call.
+        kwargs: The keyword arguments of the call.
+
+    Returns:
+        The batch size.
+    '''
+
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, (list, tuple)):
+            return len(value)
+    return kwargs.get('limit', 1)
+
+
+
+
+class InstrumentedSpotify:
+    '''
+    Wraps a Spotipy object so every Spotipy method call is measured: its endpoint (the method name), batch
+    size, latency and final HTTP status (after the transport's retries) are added to the registry and, if given,
+    to a request's trace. Every response, including retried ones, is counted by record_response.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        trace: Optional Trace the calls are also added to.
+    '''
+
+    def __init__(self, sp, trace=None):
+        self._sp = sp
+        self._trace = trace
+
+    def __getattr__(self, name):
+        attribute = getattr(self._sp, name)
+        if not callable(attribute):
+            return attribute
+
+        def measured_call(*args, **kwargs):
+            status = 'error'
+            last_response_status.set(None)
+            start = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+
+                # Methods that don't send a request (e.g., building a URL) have no status
+                response_status = last_response_status.get()
+                status = str(response_status) if response_status != None else 'none'
+                return result
+            except SpotifyException as error:
+                status = str(error.http_status)
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                size = batch_size(args, kwargs)
+                registry.inc('spotify_api_calls_total', {'endpoint': name, 'status': status})
+                registry.observe('spotify_api_call_duration_seconds', {'endpoint': name}, seconds)
+                registry.observe('spotify_api_batch_size', {'endpoint': name}, size, buckets=BATCH_SIZE_BUCKETS)
+                if self._trace != None:
+                    self._trace.add('spotify', name, seconds, batch_size=size, status=status)
+        return measured_call
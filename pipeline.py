@@ -0,0 +1,387 @@
+import asyncio
+import helper_functions as helpers
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [---------------------------PIPELINE----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Most Spotify stages (e.g., track details batches) run at the same time by the pipeline
+PIPELINE_CONCURRENCY = 8
+
+
+
+
+class CountingSpotify:
+    '''
+    Wraps a Spotipy object so every Spotipy method call is reported to a background job's progress.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        job: The jobs.Job handle to report API calls to.
+    '''
+
+    def __init__(self, sp, job):
+        self._sp = sp
+        self._job = job
+
+    def __getattr__(self, name):
+        attribute = getattr(self._sp, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted_call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._job.add_api_calls()
+        return counted_call
+
+
+
+
+def estimate_new_tracks_api_calls(track_list):
+    '''
+    Estimates the Spotify API calls needed to prepare the new track_list from track_list, for progress ETAs:
+    one recommendations call per seed window, then track details, artists and audio features for the up to
+    5 new tracks per window.
+
+    Args:
+        track_list: The user's top tracks.
+
+    Returns:
+        The estimated number of API calls.
+    '''
+
+    windows = min(-(-len(track_list) // helpers.RECOMMENDATIONS_SEED_SIZE), helpers.RECOMMENDATIONS_MAX_WINDOWS)
+    new_tracks = windows * 5
+    track_calls = -(-new_tracks // 50)
+    artist_calls = -(-new_tracks * 2 // 50)
+    audio_features_calls = -(-new_tracks // 100)
+    return windows + track_calls + artist_calls + audio_features_calls
+
+
+
+
+async def run_stage(function, *args, **kwargs):
+    '''
+    Runs a blocking helper function in a worker thread, so the event loop can run other stages while it
+    waits on Spotify.
+
+    Args:
+        function: The helper function to run.
+        *args: Positional arguments passed to function.
+        **kwargs: Keyword arguments passed to function.
+
+    Returns:
+        The return value of function.
+    '''
+
+    return await asyncio.to_thread(function, *args, **kwargs)
+
+
+
+
+async def stream_top_tracks(sp, total=500, page_size=50, max_workers=helpers.TOP_TRACKS_MAX_WORKERS):
+    '''
+    Streams in the current user's top tracks page by page. Every page is requested at the same time (by
+    helpers.stream_top_tracks), and each is yielded as soon as it and the pages before it arrive.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        total: The maximum number of top tracks to get.
+        page_size: The number of tracks requested per page.
+        max_workers: The most pages requested at the same time.
+
+    Yields:
+        A list of track objects for each page, in the same order Spotify ranks them.
+    '''
+
+    pages = helpers.stream_top_tracks(sp, total=total, page_size=page_size, max_workers=max_workers)
+    try:
+        while True:
+
+            # Wait for the next page in a worker thread, so other stages keep running meanwhile
+            new_tracks = await run_stage(next, pages, None)
+            if new_tracks == None:
+                break
+            yield new_tracks
+    finally:
+        pages.close()
+
+
+
+
+async def get_top_tracks(sp, total=500, page_size=50):
+    '''
+    Gets the current user's top tracks, requesting every page at the same time.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        total: The maximum number of top tracks to get.
+        page_size: The number of tracks requested per page.
+
+    Returns:
+        A list of track objects, in the same order Spotify ranks them.
+    '''
+
+    track_list = []
+    async for new_tracks in stream_top_tracks(sp, total=total, page_size=page_size):
+        track_list.extend(new_tracks)
+    return track_list
+
+
+
+
+async def get_new_tracks(track_list, sp, concurrency=PIPELINE_CONCURRENCY):
+    '''
+    Gets new tracks to replace track_list. Recommendations are requested first, then the track details of
+    every group of 50 new tracks are requested at the same time.
+
+    Args:
+        track_list: A list of familiar track objects.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        concurrency: The most Spotify calls made at the same time.
+
+    Returns:
+        A list of new track objects.
+    '''
+
+    new_track_ids = await run_stage(helpers.get_new_track_ids, track_list, sp, max_workers=concurrency)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_details(ids):
+        async with semaphore:
+            return await run_stage(helpers.set_novel_track_list, ids, sp)
+
+    groups = await asyncio.gather(*[
+        get_details(new_track_ids[offset:offset+50]) for offset in range(0, len(new_track_ids), 50)
+    ])
+    return [track for group in groups for track in group]
+
+
+
+
+async def enrich_tracks(track_list, sp, genre_stats=None):
+    '''
+    Sets the genres and audio features of every track in track_list. The two stages don't depend on each
+    other, so they run at the same time. Album art is captured when the track objects are created, and any
+    missing art is filled in later by get_final_playlist.
+
+    Args:
+        track_list: A list of track objects.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        genre_stats: Optional dictionary passed to set_artist_genres as its stats.
+
+    Returns:
+        track_list, updated with genres and audio features.
+    '''
+
+    await asyncio.gather(
+        run_stage(helpers.set_artist_genres, track_list, sp, stats=genre_stats),
+        run_stage(helpers.get_audio_features, track_list, sp)
+    )
+    return track_list
+
+
+
+
+async def ingest_top_tracks(sp, genre_stats=None, on_page=None, on_streamed=None,
+                            max_workers=helpers.TOP_TRACKS_MAX_WORKERS):
+    '''
+    Streams in the current user's top tracks and sets the genres and audio features of each page as soon as it
+    arrives, while the later pages are still being requested. The pages' artist and audio features lookups
+    run at the same time, so the helpers' lookup coalescers merge them into full batches.
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        genre_stats: Optional dictionary. If given, it is filled with the set_artist_genres counters, added 
+            up over every page.
+        on_page: Optional function called with each page of track objects as it arrives, e.g., to report
+            progress. It may raise jobs.JobCancelled to stop.
+        on_streamed: Optional function called with the track_list once every page has arrived, while the last
+            pages' genres and audio features may still be being set.
+        max_workers: The most top tracks pages requested at the same time.
+
+    Returns:
+        The track_list of top tracks, with genres and audio features set.
+    '''
+
+    track_list = []
+    enrichments = []
+    page_stats = []
+    async for new_tracks in stream_top_tracks(sp, max_workers=max_workers):
+        track_list.extend(new_tracks)
+        if on_page != None:
+            on_page(new_tracks)
+        page_stats.append({})
+        enrichments.append(asyncio.create_task(enrich_tracks(new_tracks, sp, genre_stats=page_stats[-1])))
+
+    if on_streamed != None:
+        on_streamed(track_list)
+    await asyncio.gather(*enrichments)
+
+    if genre_stats != None:
+        for stats in page_stats:
+            for name, value in stats.items():
+                genre_stats[name] = genre_stats.get(name, 0) + value
+
+    return track_list
+
+
+
+
+async def prepare_track_list(track_list, sp, new_or_familiar, genre_stats=None, concurrency=PIPELINE_CONCURRENCY):
+    '''
+    Runs the stages needed before the user picks genres and audio features: new tracks (for "new"), then
+    genres and audio features. Top tracks are fetched first if track_list is None; for "familiar" they are
+    streamed in and enriched page by page.
+
+    Args:
+        track_list: The user's top tracks, or None to fetch them.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        new_or_familiar: The choice (new or familiar) the user selected on newOrFamiliar.html.
+        genre_stats: Optional dictionary passed to set_artist_genres as its stats.
+        concurrency: The most Spotify calls made at the same time by a stage.
+
+    Returns:
+        The track_list, with genres and audio features set.
+    '''
+
+    if track_list == None and new_or_familiar == 'familiar':
+        return await ingest_top_tracks(sp, genre_stats=genre_stats)
+    if track_list == None:
+        track_list = await get_top_tracks(sp)
+    if new_or_familiar == 'new':
+        track_list = await get_new_tracks(track_list, sp, concurrency=concurrency)
+    return await enrich_tracks(track_list, sp, genre_stats=genre_stats)
+
+
+
+
+def prefetch_track_lists(job, track_list, sp, prefetch_new=False, concurrency=PIPELINE_CONCURRENCY,
+                         top_tracks_workers=helpers.TOP_TRACKS_MAX_WORKERS):
+    '''
+    Background job started while the user is on newOrFamiliar.html. Sets the genres and audio features of the
+    familiar track_list and, if prefetch_new is True, also prepares the new track_list, so genres_page can 
+    render from data that is already warm. Stops between stages (and between top tracks pages) if the job is
+    cancelled.
+
+    If track_list is None, the top tracks are streamed in first, each page reported to the job's progress as 
+    it arrives and enriched while the later pages are still being requested. Once every page is in, the top
+    tracks are set as the job's partial result, so the "new" tracks job can start from them without waiting
+    for their genres and audio features.
+
+    Args:
+        job: The jobs.Job handle for this job.
+        track_list: The user's top tracks, or None to stream them in. This list is enriched in place.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        prefetch_new: Whether to also get and enrich the new tracks.
+        concurrency: The most Spotify calls made at the same time by a stage.
+        top_tracks_workers: The most top tracks pages requested at the same time.
+
+    Returns:
+        A dictionary with a "familiar" entry, and a "new" entry if prefetch_new is True. Each entry is a 
+        tuple of (track_list, genre_stats).
+    '''
+
+    prepared = {}
+
+    job.raise_if_cancelled()
+    genre_stats = {}
+    if track_list == None:
+        job.set_stage('top tracks')
+
+        def on_page(new_tracks):
+            job.raise_if_cancelled()
+            job.add_items(len(new_tracks))
+
+        def on_streamed(top_tracks):
+            job.set_stage('genres and audio features')
+            job.set_partial_result(top_tracks)
+
+        track_list = run(ingest_top_tracks(
+            sp, genre_stats=genre_stats, on_page=on_page, on_streamed=on_streamed, max_workers=top_tracks_workers
+        ))
+    else:
+        run(enrich_tracks(track_list, sp, genre_stats=genre_stats))
+    prepared['familiar'] = (track_list, genre_stats)
+
+    if prefetch_new:
+        job.raise_if_cancelled()
+        new_track_list = run(get_new_tracks(track_list, sp, concurrency=concurrency))
+        job.raise_if_cancelled()
+        genre_stats = {}
+        run(enrich_tracks(new_track_list, sp, genre_stats=genre_stats))
+        prepared['new'] = (new_track_list, genre_stats)
+
+    return prepared
+
+
+
+
+def prepare_new_tracks_job(job, track_list, sp, top_tracks_job=None, concurrency=PIPELINE_CONCURRENCY):
+    '''
+    Background job for the "new" choice on genres_page. Replaces track_list with new tracks, then sets their
+    genres and audio features, reporting each stage and every Spotify API call to the job's progress.
+
+    Args:
+        job: The jobs.Job handle for this job.
+        track_list: The user's top tracks, or None to get them first.
+        sp: The Spotipy object used for accessing Spotipy methods.
+        top_tracks_job: Optional prefetch_track_lists job streaming in the top tracks. If track_list is None,
+            its top tracks are used as soon as they are all in, instead of getting them again.
+        concurrency: The most Spotify calls made at the same time by a stage.
+
+    Returns:
+        A tuple of (track_list, genre_stats) for the new tracks.
+    '''
+
+    counting_sp = CountingSpotify(sp, job)
+
+    if track_list == None:
+        job.set_stage('top tracks')
+        if top_tracks_job != None:
+            track_list = top_tracks_job.partial_result()
+
+        # No prefetch, or it failed or was cancelled before the top tracks were all in
+        if track_list == None:
+            track_list = run(get_top_tracks(counting_sp))
+        job.raise_if_cancelled()
+
+    job.set_stage('recommendations', api_calls_expected=estimate_new_tracks_api_calls(track_list))
+    new_track_list = run(get_new_tracks(track_list, counting_sp, concurrency=concurrency))
+
+    job.raise_if_cancelled()
+    job.set_stage('genres and audio features')
+    genre_stats = {}
+    run(enrich_tracks(new_track_list, counting_sp, genre_stats=genre_stats))
+
+    return new_track_list, genre_stats
+
+
+
+
+def run(coroutine):
+    '''
+    Sync bridge for calling the pipeline from Flask routes, which aren't async. Runs coroutine on a new event
+    loop and waits for it to finish.
+
+    Args:
+        coroutine: A pipeline coroutine, e.g., prepare_track_list(...).
+
+    Returns:
+        The coroutine's return value.
+    '''
+
+    return asyncio.run(coroutine)
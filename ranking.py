@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict
+import feature_index
+import scoring
+from helper_functions import AUDIO_FEATURES, PLAYLIST_SIZE
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-------------------------LIVE RANKING--------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Most users whose prepared rankings are kept in memory before the least recently used are dropped
+RANKING_CACHE_SIZE = 1000
+
+# Most tracks returned by a live ranking
+MAX_RANKING_SIZE = 100
+
+# Tracks from which a live ranking searches FeatureIndex trees for its candidates instead of scoring every
+# track, and the most distinct base scores (one tree each) that are indexed. Base scores only differ by the 
+# genre deduction, so there are usually one or two. NumPy scores every track about as fast as the trees up to
+# about 50,000 tracks; plain lists only up to a few thousand
+INDEX_MIN_TRACKS = 5000 if scoring.np == None else 100000
+INDEX_MAX_BASE_SCORES = 4
+
+
+
+
+class PreparedRanking:
+    '''
+    Everything needed to rank one user's track_list against slider values, held in memory so re-ranking
+    doesn't touch the Flask session or Spotify: the feature matrix (a row per track, a column per audio
+    feature), each track's score before the audio features deduction, and the track fields sent to the page.
+
+    Large track lists also get a FeatureIndex per distinct base score. Within one base score, the highest
+    scores are the tracks closest to the slider values, so each tree's k nearest tracks are the only
+    candidates that can make the top k, and only they are scored.
+
+    Args:
+        track_list: The track_list object from the Flask session.
+        genre_deductions: Optional genre deduction of each track, from the user's score components.
+        index_min_tracks: The fewest tracks for which FeatureIndex trees are built.
+    '''
+
+    def __init__(self, track_list, genre_deductions=None, index_min_tracks=INDEX_MIN_TRACKS):
+        base_scores = [track['score'] for track in track_list]
+        if genre_deductions != None:
+            base_scores = scoring.combine_scores(base_scores, genre_deductions)
+
+        self.feature_names = list(AUDIO_FEATURES)
+        self.feature_matrix = scoring.build_feature_matrix(track_list, self.feature_names)
+        self.base_scores = base_scores
+        self.tracks = [
+            {
+                'track_id': track['track_id'],
+                'track_name': track['track_name'],
+                'artists': track['artists'],
+                'album_art': track.get('album_art')
+            }
+            for track in track_list
+        ]
+
+        # One tree per base score, each a tuple of (base score, positions in track_list, FeatureIndex)
+        self.indexes = []
+        if len(track_list) >= index_min_tracks:
+            positions_by_score = {}
+            for position, base_score in enumerate(base_scores):
+                positions_by_score.setdefault(float(base_score), []).append(position)
+            if len(positions_by_score) <= INDEX_MAX_BASE_SCORES:
+                for base_score, positions in positions_by_score.items():
+                    index = feature_index.FeatureIndex(
+                        [track_list[position] for position in positions], self.feature_names
+                    )
+                    self.indexes.append((base_score, positions, index))
+
+    def rank(self, input_values, k=PLAYLIST_SIZE):
+        '''
+        Ranks the tracks against the user's slider values, using the same deductions as the final playlist.
+
+        Args:
+            input_values: The values (0-100) of each slider on features.html, by audio feature name. Features
+                that are left out aren't scored.
+            k: The number of tracks to return.
+
+        Returns:
+            A list of the k highest scoring tracks, highest score first, each with its "score".
+        '''
+
+        k = min(k, MAX_RANKING_SIZE)
+        columns = [column for column, name in enumerate(self.feature_names) if name in input_values]
+        user_values = [float(input_values[self.feature_names[column]]) for column in columns]
+
+        # Only score the tracks closest to the slider values in each tree, in track_list order so equal scores 
+        # keep the same order as scoring every track
+        candidates = None
+        base_scores = self.base_scores
+        feature_matrix = self.feature_matrix
+        if self.indexes:
+            candidates = sorted(
+                positions[position] for _, positions, index in self.indexes
+                for position, _ in index.query(input_values, k)
+            )
+            base_scores = [base_scores[position] for position in candidates]
+            if scoring.np == None:
+                feature_matrix = [feature_matrix[position] for position in candidates]
+            else:
+                feature_matrix = feature_matrix[candidates]
+
+        # Only slice the matrix when some sliders are left out
+        if len(columns) != len(self.feature_names):
+            if scoring.np == None:
+                feature_matrix = [[row[column] for column in columns] for row in feature_matrix]
+            else:
+                feature_matrix = feature_matrix[:, columns]
+
+        scores = scoring.feature_deductions(base_scores, feature_matrix, user_values)
+        top_positions = scoring.top_k_indices(scores, k)
+        if candidates != None:
+            top_positions = [candidates[position] for position in top_positions]
+            scores = dict(zip(candidates, scores))
+        return [
+            dict(self.tracks[position], score=round(float(scores[position]), 2))
+            for position in top_positions
+        ]
+
+
+
+
+class RankingCache:
+    '''
+    Keeps each user's PreparedRanking for the life of the process. A ranking is rebuilt when the user's
+    track_list or genre selection changes, which is detected with a version key supplied by the caller.
+
+    Args:
+        max_size: The most rankings kept before the least recently used are dropped.
+    '''
+
+    def __init__(self, max_size=RANKING_CACHE_SIZE):
+        self.max_size = max_size
+        self._rankings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_key, version, build):
+        '''
+        Gets a user's prepared ranking, building it if the user has none or its version changed.
+
+        Args:
+            user_key: A key that identifies the user, e.g., a value saved in their Flask session.
+            version: Any value that changes whenever the ranking's inputs change.
+            build: A function that takes no arguments and returns a new PreparedRanking.
+
+        Returns:
+            The PreparedRanking.
+        '''
+
+        with self._lock:
+            entry = self._rankings.get(user_key)
+            if entry != None and entry[0] == version:
+                self._rankings.move_to_end(user_key)
+                return entry[1]
+
+        # Build outside the lock, so other users aren't kept waiting
+        ranking = build()
+        with self._lock:
+            self._rankings[user_key] = (version, ranking)
+            self._rankings.move_to_end(user_key)
+            while len(self._rankings) > self.max_size:
+                self._rankings.popitem(last=False)
+        return ranking
+
+    def remove(self, user_key):
+        with self._lock:
+            self._rankings.pop(user_key, None)
@@ -0,0 +1,322 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+import metrics
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-------------------------RATE LIMITER--------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Default Spotify API calls allowed per second across all users, and the most that can be made at once after a
+# quiet period. Spotify doesn't publish its limit, so these are only a starting point: the limit is off unless
+# it is turned on (see SPOTIFY_RATE_LIMIT in main.py), and should be tuned from the 429s counted on /metrics
+# (spotify_http_responses_total, which includes the 429s that were retried)
+RATE = 10.0
+BURST = 30
+
+# Priorities of Spotify calls. Interactive calls (a user is waiting on the page, e.g., get_album_art) are
+# always let through before bulk calls (background work, e.g., get_new_tracks), whether or not there is a
+# rate limit: they are also first in line for the transport's host slots (see spotify_clients)
+INTERACTIVE = 0
+BULK = 1
+
+# The RateLimitedSpotify whose call is being made in this context, so the transport can give its requests
+# their priority and take a token for each retry
+current_call = contextvars.ContextVar('current_call', default=None)
+
+
+
+
+class MemoryTokenBucket:
+    '''
+    A token bucket kept in this process. Tokens are added at rate per second, up to burst.
+
+    Args:
+        rate: Tokens added per second.
+        burst: The most tokens the bucket holds.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self):
+        '''
+        Takes one token if there is one.
+
+        Args:
+            None
+
+        Returns:
+            0 if a token was taken, otherwise the seconds until the next token is added.
+        '''
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+
+
+class FileTokenBucket:
+    '''
+    A token bucket kept in a small file, so every process using the same file (e.g., several Flask workers on
+    one server) shares one rate. The file is locked while it is read and updated. Uses fcntl, so it is only
+    available on Unix.
+
+    Args:
+        path: The file the bucket is kept in. It is created if it doesn't exist.
+        rate: Tokens added per second.
+        burst: The most tokens the bucket holds.
+    '''
+
+    def __init__(self, path, rate, burst):
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+
+    def try_take(self):
+        with self._lock:
+            file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self._fcntl.flock(file_descriptor, self._fcntl.LOCK_EX)
+                contents = os.read(file_descriptor, 256)
+
+                # Wall clock time, since monotonic clocks aren't comparable between processes
+                now = time.time()
+                try:
+                    state = json.loads(contents)
+                    tokens = min(self.burst, state['tokens'] + max(now - state['updated_at'], 0) * self.rate)
+                except ValueError:
+                    tokens = float(self.burst)
+
+                wait = 0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+
+                os.lseek(file_descriptor, 0, os.SEEK_SET)
+                os.ftruncate(file_descriptor, 0)
+                os.write(file_descriptor, json.dumps({'tokens': tokens, 'updated_at': now}).encode())
+                return wait
+            finally:
+                self._fcntl.flock(file_descriptor, self._fcntl.LOCK_UN)
+                os.close(file_descriptor)
+
+
+
+
+class TokenBucketScheduler:
+    '''
+    Lets Spotify calls through at the bucket's rate, across all users. Calls that have to wait are queued by
+    priority, and within a priority the users take turns (round robin), so one user's hundred recommendations
+    calls can't hold up another user's page.
+
+    Waiting calls dispatch each other: whenever a waiting call wakes up, it hands out every token available
+    to the calls at the front of the queue, so no extra thread is needed.
+
+    Args:
+        rate: Calls allowed per second.
+        burst: The most calls allowed at once after a quiet period.
+        shared_path: Optional file to share the rate with other processes (see FileTokenBucket).
+    '''
+
+    def __init__(self, rate=RATE, burst=BURST, shared_path=None):
+        if shared_path != None:
+            self.bucket = FileTokenBucket(shared_path, rate, burst)
+        else:
+            self.bucket = MemoryTokenBucket(rate, burst)
+
+        # A queue per priority, each an OrderedDict of user key to that user's waiting calls
+        self._queues = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if users:
+
+                # Take the first user's oldest call, then move the user to the back for round robin
+                user_key, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user_key)
+                else:
+                    del users[user_key]
+                return waiter
+        return None
+
+    def _dispatch(self):
+
+        # Hand out the available tokens to the front of the queue. Returns the seconds until the next token
+        with self._lock:
+            while self._waiting > 0:
+                wait = self.bucket.try_take()
+                if wait > 0:
+                    return wait
+                self._next_waiter().set()
+                self._waiting -= 1
+        return 0
+
+    def acquire(self, user_key, priority=INTERACTIVE):
+        '''
+        Waits until the call may be made.
+
+        Args:
+            user_key: A key that identifies the user making the call.
+            priority: INTERACTIVE or BULK.
+
+        Returns:
+            The seconds spent waiting.
+        '''
+
+        start = time.monotonic()
+        with self._lock:
+
+            # Skip the queue if no one is waiting and a token is available
+            if self._waiting == 0 and self.bucket.try_take() == 0:
+                return 0.0
+
+            waiter = threading.Event()
+            self._queues[priority].setdefault(user_key, deque()).append(waiter)
+            self._waiting += 1
+
+        while not waiter.is_set():
+            wait = self._dispatch()
+            if waiter.is_set():
+                break
+            waiter.wait(timeout=max(wait, 0.001))
+
+        return time.monotonic() - start
+
+
+
+
+class PrioritySemaphore:
+    '''
+    A semaphore that hands free slots to waiting threads by priority (INTERACTIVE before BULK), first come
+    first served within a priority. A released slot is passed straight to the next waiter.
+
+    Args:
+        value: The number of slots.
+    '''
+
+    def __init__(self, value):
+        self._value = value
+        self._queues = {INTERACTIVE: deque(), BULK: deque()}
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=INTERACTIVE):
+        with self._lock:
+            if self._value > 0 and not any(self._queues.values()):
+                self._value -= 1
+                return
+            waiter = threading.Event()
+            self._queues[priority].append(waiter)
+        waiter.wait()
+
+    def release(self):
+        with self._lock:
+            for priority in sorted(self._queues):
+                if self._queues[priority]:
+                    self._queues[priority].popleft().set()
+                    return
+            self._value += 1
+
+
+
+
+def current_priority():
+    '''
+    Gets the priority of the Spotify call being made in this context.
+
+    Args:
+        None
+
+    Returns:
+        The priority of the current RateLimitedSpotify call, or INTERACTIVE if there is none.
+    '''
+
+    call = current_call.get()
+    return call.priority if call != None else INTERACTIVE
+
+
+
+
+class RateLimitedSpotify:
+    '''
+    Wraps a Spotipy object so every Spotipy method call has the object's priority, and first waits its turn
+    with the scheduler if there is one. The priority orders the transport's requests even without a rate 
+    limit, and the transport's retries also wait their turn (see spotify_clients.SpotifyRetry).
+
+    Args:
+        sp: The Spotipy object used for accessing Spotipy methods.
+        scheduler: The TokenBucketScheduler shared by all users, or None for no rate limit.
+        user_key: A key that identifies the user, e.g., a value saved in their Flask session.
+        priority: INTERACTIVE for calls a user is waiting on, BULK for background work.
+    '''
+
+    def __init__(self, sp, scheduler, user_key, priority=INTERACTIVE):
+        self._sp = sp
+        self._scheduler = scheduler
+        self._user_key = user_key
+        self.priority = priority
+
+    def __getattr__(self, name):
+        attribute = getattr(self._sp, name)
+        if not callable(attribute):
+            return attribute
+
+        def scheduled_call(*args, **kwargs):
+            self.wait_turn()
+            token = current_call.set(self)
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                current_call.reset(token)
+        return scheduled_call
+
+    def wait_turn(self):
+        '''
+        Waits until the scheduler lets a request through, for each call and each of its retries. Returns at
+        once if there is no rate limit.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+        if self._scheduler == None:
+            return
+        waited = self._scheduler.acquire(self._user_key, self.priority)
+        if metrics.ENABLED:
+            priority = 'interactive' if self.priority == INTERACTIVE else 'bulk'
+            metrics.registry.observe('rate_limit_wait_seconds', {'priority': priority}, waited)
@@ -0,0 +1,314 @@
+import heapq
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [------------------------SCORING ENGINE-------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Most points a track can lose per audio feature, as used in helper_functions.feature_score_deduction
+FEATURE_DEDUCTION_POINTS = 10
+
+# Points a track loses when none of its genres were selected, as used in helper_functions.genre_score_deduction
+GENRE_DEDUCTION_POINTS = 20
+
+
+
+
+def build_feature_matrix(track_list, feature_names):
+    '''
+    Packs the audio features of every track in track_list into one matrix, with a row per track and a column
+    per feature in feature_names. Uses a contiguous NumPy array when NumPy is installed, otherwise a list of
+    rows. Missing (None) feature values are stored as NaN, which the deductions treat as "no deduction".
+
+    Args:
+        track_list: The track_list object from the Flask session.
+        feature_names: The audio features to pack, in column order.
+
+    Returns:
+        The feature matrix.
+    '''
+
+    rows = [
+        [float('nan') if track[feature_name] == None else track[feature_name] for feature_name in feature_names]
+        for track in track_list
+    ]
+    if np == None:
+        return rows
+    return np.array(rows, dtype=np.float64).reshape(len(rows), len(feature_names))
+
+
+
+
+def feature_deductions(scores, feature_matrix, user_values):
+    '''
+    Deducts points from every score at once based on the delta between each track's features and the user's
+    values. Each feature is applied in column order with the same arithmetic as feature_score_deduction, so
+    the results are identical to deducting track by track.
+
+    Args:
+        scores: The current score of each track, in the same order as the rows of feature_matrix.
+        feature_matrix: The matrix returned by build_feature_matrix.
+        user_values: The user's value (0-100) for each column of feature_matrix.
+
+    Returns:
+        The updated scores, as a NumPy array when NumPy is installed, otherwise a list.
+    '''
+
+    if np == None:
+        new_scores = []
+        for score, row in zip(scores, feature_matrix):
+            for track_feature_value, user_value in zip(row, user_values):
+                value_difference = abs(track_feature_value * 100 - user_value)
+
+                # NaN (missing feature) and zero differences don't deduct anything
+                if value_difference > 0:
+                    score -= FEATURE_DEDUCTION_POINTS * (value_difference / 100)
+            new_scores.append(score)
+        return new_scores
+
+    new_scores = np.array(scores, dtype=np.float64)
+    for column, user_value in enumerate(user_values):
+        value_difference = np.abs(feature_matrix[:, column] * 100 - user_value)
+        deduction = FEATURE_DEDUCTION_POINTS * (value_difference / 100)
+        new_scores -= np.where(value_difference > 0, deduction, 0.0)
+    return new_scores
+
+
+
+
+def build_genre_index(track_list):
+    '''
+    Interns every genre in track_list into an integer ID and stores each track's genres as a bitmask, where
+    bit n is set if the track has the genre with ID n. Python ints are used as the bitsets, so there is no
+    limit on the number of genres.
+
+    Args:
+        track_list: The track_list object from the Flask session.
+
+    Returns:
+        genre_ids: A dictionary of genre to its integer ID.
+        track_masks: The genre bitmask of each track, in the same order as track_list.
+    '''
+
+    genre_ids = {}
+    track_masks = []
+    for track in track_list:
+        mask = 0
+        for genre in track['genres']:
+            genre_id = genre_ids.setdefault(genre, len(genre_ids))
+            mask |= 1 << genre_id
+        track_masks.append(mask)
+
+    return genre_ids, track_masks
+
+
+
+
+def compile_genre_mask(genre_input, genre_ids):
+    '''
+    Compiles the user's selected genres into one bitmask that can be matched against the track masks from
+    build_genre_index. Genres that no track has are ignored.
+
+    Args:
+        genre_input: A list of genres the user selected on genres.html
+        genre_ids: The genre IDs returned by build_genre_index.
+
+    Returns:
+        The bitmask of the selected genres.
+    '''
+
+    mask = 0
+    for genre in genre_input:
+        if genre in genre_ids:
+            mask |= 1 << genre_ids[genre]
+    return mask
+
+
+
+
+def genre_deductions(scores, track_masks, genre_mask):
+    '''
+    Deducts points from every track that has none of the selected genres. Matching a track is a single AND
+    of its mask with genre_mask.
+
+    Args:
+        scores: The current score of each track, in the same order as track_masks.
+        track_masks: The track masks returned by build_genre_index.
+        genre_mask: The mask returned by compile_genre_mask.
+
+    Returns:
+        The updated scores, as a list.
+    '''
+
+    return [
+        score if track_mask & genre_mask else score - GENRE_DEDUCTION_POINTS
+        for score, track_mask in zip(scores, track_masks)
+    ]
+
+
+
+
+def select_top_tracks(track_list, k):
+    '''
+    Selects the k tracks with the highest scores without sorting the whole list, in O(n log k). Tracks with 
+    equal scores keep their order in track_list, so the result is the same as sorting track_list by score 
+    (highest first) and keeping the first k.
+
+    Args:
+        track_list: The track_list object from the Flask session.
+        k: The number of tracks to select.
+
+    Returns:
+        A list of the k highest scoring tracks, highest score first.
+    '''
+
+    return heapq.nlargest(k, track_list, key=lambda track: track['score'])
+
+
+
+
+def genre_deduction_vector(track_list, genre_input):
+    '''
+    Computes the genre component of every track's score on its own: the points each track loses for having
+    none of the selected genres.
+
+    Args:
+        track_list: The track_list object from the Flask session.
+        genre_input: A list of genres the user selected on genres.html
+
+    Returns:
+        The deduction of each track, in the same order as track_list.
+    '''
+
+    genre_ids, track_masks = build_genre_index(track_list)
+    genre_mask = compile_genre_mask(genre_input, genre_ids)
+    return [0.0 if track_mask & genre_mask else float(GENRE_DEDUCTION_POINTS) for track_mask in track_masks]
+
+
+
+
+def feature_deduction_vector(feature_matrix, user_values):
+    '''
+    Computes the audio features component of every track's score on its own: the total points each track
+    loses for the delta between its features and the user's values.
+
+    Args:
+        feature_matrix: The matrix returned by build_feature_matrix.
+        user_values: The user's value (0-100) for each column of feature_matrix.
+
+    Returns:
+        The deduction of each track, in the same order as the rows of feature_matrix.
+    '''
+
+    deducted = feature_deductions([0.0] * len(feature_matrix), feature_matrix, user_values)
+    return [-float(deduction) for deduction in deducted]
+
+
+
+
+def combine_scores(base_scores, *deduction_vectors):
+    '''
+    Combines the score components of every track into its final score: the base score minus each deduction.
+
+    Args:
+        base_scores: The base score of each track.
+        *deduction_vectors: Deduction vectors, e.g., from genre_deduction_vector and feature_deduction_vector.
+
+    Returns:
+        The final score of each track, as a list.
+    '''
+
+    if np == None:
+        scores = list(base_scores)
+        for deductions in deduction_vectors:
+            scores = [score - deduction for score, deduction in zip(scores, deductions)]
+        return scores
+
+    scores = np.array(base_scores, dtype=np.float64)
+    for deductions in deduction_vectors:
+        scores -= np.asarray(deductions, dtype=np.float64)
+    return scores.tolist()
+
+
+
+
+def pack_vector(values):
+    '''
+    Packs a vector of floats into bytes, for storing a score component in the Flask session.
+
+    Args:
+        values: A list of floats.
+
+    Returns:
+        The packed vector.
+    '''
+
+    return array('d', values).tobytes()
+
+
+
+
+def unpack_vector(data):
+    '''
+    Unpacks a vector packed by pack_vector.
+
+    Args:
+        data: The packed vector.
+
+    Returns:
+        A list of floats.
+    '''
+
+    values = array('d')
+    values.frombytes(data)
+    return values.tolist()
+
+
+
+
+def top_k_indices(scores, k):
+    '''
+    Finds the positions of the k highest scores without sorting every score. Equal scores keep their order,
+    the same as select_top_tracks.
+
+    Args:
+        scores: The score of each track, as a NumPy array or a list.
+        k: The number of positions to return.
+
+    Returns:
+        A list of the positions of the k highest scores, highest score first.
+    '''
+
+    k = min(k, len(scores))
+    if k <= 0:
+        return []
+    if np == None:
+        return heapq.nlargest(k, range(len(scores)), key=lambda position: (scores[position], -position))
+
+    scores = np.asarray(scores, dtype=np.float64)
+
+    # Find the k-th highest score in O(n), then keep every score above it and the first scores equal to it
+    threshold = -np.partition(-scores, k - 1)[k - 1]
+    above = np.flatnonzero(scores > threshold)
+    equal = np.flatnonzero(scores == threshold)[:k - len(above)]
+    candidates = np.concatenate([above, equal])
+    candidates.sort()
+
+    # Order the candidates by score, keeping equal scores in position order
+    order = np.argsort(-scores[candidates], kind='stable')
+    return candidates[order].tolist()
@@ -0,0 +1,289 @@
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+import rate_limiter
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [---------------------------TRANSPORT---------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Number of keep-alive connections kept open per host
+POOL_SIZE = 20
+
+# Most requests sent to one host at the same time, across all users. Further requests wait for a free slot
+HOST_CONCURRENCY = 20
+
+# Retries for rate limited (429) and server error (5xx) responses. Waits grow exponentially from
+# RETRY_BACKOFF seconds with up to RETRY_JITTER seconds of random jitter, unless Spotify sends Retry-After
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_JITTER = 0.5
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Longest wait in seconds before a retry. Spotify's Retry-After can ask for minutes when the app is rate limited 
+# for a long time; waits are cut to this so a request (and the worker handling it) isn't held that long
+MAX_RETRY_WAIT = 10
+
+# The host slot (see HostLimitedAdapter) held by the request this thread is sending, and the request's 
+# priority, so the slot can be freed while the request waits to be retried
+host_slot = threading.local()
+
+
+
+
+class SpotifyRetry(Retry):
+    '''
+    urllib3 Retry that counts each response it retries (see metrics.record_response), caps Retry-After at
+    backoff_max like the exponential backoff, and frees the request's host slot while it waits. Each retry
+    waits its turn with the rate limiter like a new call. The retried 429 and 5xx responses never reach 
+    requests, so the session's response hook only sees the last one.
+    '''
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after == None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+    def sleep(self, response=None):
+
+        # Other requests to the host can use the slot while this one waits
+        semaphore = getattr(host_slot, 'semaphore', None)
+        if semaphore != None:
+            semaphore.release()
+        try:
+            super().sleep(response)
+
+            # A retry is another request to Spotify, so it takes a token like any call
+            call = rate_limiter.current_call.get()
+            if call != None:
+                call.wait_turn()
+        finally:
+            if semaphore != None:
+                semaphore.acquire(host_slot.priority)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+
+        # Counted only once the retry is allowed; when retries run out the response is returned, and the
+        # response hook counts it
+        if response != None:
+            metrics.record_response(url, response.status)
+        return retry
+
+
+
+
+def record_response_hook(response, *args, **kwargs):
+    metrics.record_response(response.url, response.status_code)
+
+
+
+
+class HostLimitedAdapter(HTTPAdapter):
+    '''
+    A requests transport adapter that limits how many requests are sent to each host at the same time. 
+    Requests waiting for a slot get one by the priority of their call (see rate_limiter.current_priority).
+    Connection pooling and retries are handled by HTTPAdapter; a request waiting to be retried gives up its
+    slot until the retry (see SpotifyRetry.sleep).
+
+    Args:
+        host_concurrency: The most requests sent to one host at the same time.
+        **kwargs: Arguments passed to HTTPAdapter, e.g., pool_maxsize and max_retries.
+    '''
+
+    def __init__(self, host_concurrency, **kwargs):
+        self.host_concurrency = host_concurrency
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def _semaphore(self, host):
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = rate_limiter.PrioritySemaphore(self.host_concurrency)
+            return self._host_semaphores[host]
+
+    def send(self, request, **kwargs):
+        semaphore = self._semaphore(urlsplit(request.url).netloc)
+        priority = rate_limiter.current_priority()
+        semaphore.acquire(priority)
+        host_slot.semaphore = semaphore
+        host_slot.priority = priority
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            host_slot.semaphore = None
+            semaphore.release()
+
+
+
+
+class SharedHTTPSession(requests.Session):
+    '''
+    The requests.Session shared by every Spotipy object. Spotipy closes its session when the Spotipy object is
+    garbage collected, which would close the pooled connections of every other user whenever one client is 
+    dropped (e.g., on a token refresh). close() is therefore ignored; the connections are only closed by 
+    close_connections() when the process shuts down.
+    '''
+
+    def close(self):
+        pass
+
+    def close_connections(self):
+        super().close()
+
+
+
+
+def create_http_session(pool_size=POOL_SIZE, host_concurrency=HOST_CONCURRENCY, max_retries=MAX_RETRIES,
+                        backoff=RETRY_BACKOFF, jitter=RETRY_JITTER, max_wait=MAX_RETRY_WAIT):
+    '''
+    Creates the requests.Session shared by all Spotipy objects. Connections are kept alive and pooled, 
+    rate limited and server error responses are retried with jittered exponential backoff (honoring 
+    Retry-After, up to max_wait seconds), and requests per host are capped at host_concurrency. Every response, including retried
+    ones, is counted when metrics are enabled.
+
+    Args:
+        pool_size: The number of keep-alive connections kept open per host.
+        host_concurrency: The most requests sent to one host at the same time.
+        max_retries: The number of retries for 429 and 5xx responses.
+        backoff: The wait in seconds before the first retry. Doubles after each retry.
+        jitter: The most random seconds added to each wait.
+        max_wait: The longest wait in seconds before a retry, including waits asked for by Retry-After.
+
+    Returns:
+        The SharedHTTPSession.
+    '''
+
+    retry = SpotifyRetry(
+        total=max_retries,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=backoff,
+        backoff_jitter=jitter,
+        backoff_max=max_wait,
+        respect_retry_after_header=True,
+
+        # Return the last response instead of raising, so Spotipy raises its usual SpotifyException
+        raise_on_status=False
+    )
+    adapter = HostLimitedAdapter(
+        host_concurrency,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry
+    )
+    http_session = SharedHTTPSession()
+    http_session.hooks['response'].append(record_response_hook)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-------------------------CLIENT POOL---------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+class SpotifyClientPool:
+    '''
+    Keeps one Spotipy object per user for the life of the process, so it doesn't need to be stored in (and
+    unpickled from) the Flask session on every request. Only the user's token is kept in the session; the
+    client is rebuilt from it when the token changes or the client was evicted. All clients share one
+    requests.Session (see create_http_session), so HTTP keep-alive connections to the Spotify API are reused
+    across requests and users.
+
+    Args:
+        max_clients: The most clients kept before the least recently used are dropped.
+        http_session: The SharedHTTPSession shared by all clients. Defaults to create_http_session().
+        api_prefix: Optional base URL of the Spotify Web API, e.g., a local stub server for testing.
+    '''
+
+    def __init__(self, max_clients=1000, http_session=None, api_prefix=None):
+        self.max_clients = max_clients
+        self.http_session = http_session if http_session != None else create_http_session()
+        self.api_prefix = api_prefix
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_key, access_token):
+        '''
+        Gets the Spotipy object for a user, creating it if the user has none or their access token changed.
+
+        Args:
+            user_key: A key that identifies the user, e.g., a value saved in their Flask session.
+            access_token: The user's current Spotify access token.
+
+        Returns:
+            The Spotipy object used for accessing Spotipy methods.
+        '''
+
+        with self._lock:
+            entry = self._clients.get(user_key)
+            if entry != None and entry[0] == access_token:
+                self._clients.move_to_end(user_key)
+                return entry[1]
+
+            sp = spotipy.Spotify(auth=access_token, requests_session=self.http_session)
+            if self.api_prefix != None:
+                sp.prefix = self.api_prefix
+            self._clients[user_key] = (access_token, sp)
+            self._clients.move_to_end(user_key)
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return sp
+
+    def remove(self, user_key):
+        '''
+        Drops a user's Spotipy object, e.g., when they log in again.
+
+        Args:
+            user_key: The key passed to get.
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            self._clients.pop(user_key, None)
+
+    def close(self):
+        '''
+        Drops every Spotipy object and closes the shared HTTP connections, e.g., when the process shuts down.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            self._clients.clear()
+        if isinstance(self.http_session, SharedHTTPSession):
+            self.http_session.close_connections()
+        else:
+            self.http_session.close()
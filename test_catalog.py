@@ -0,0 +1,68 @@
+import sqlite3
+import time
+import pytest
+import catalog
+import helper_functions as helpers
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------TESTS-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+@pytest.fixture
+def track_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, 'LAST_USED_RESOLUTION', 0)
+    track_catalog = catalog.TrackCatalog(':memory:', helpers.AUDIO_FEATURES)
+    yield track_catalog
+    track_catalog.close()
+
+
+def test_recently_read_entries_are_evicted_last(track_catalog):
+    cache = catalog.CatalogCache(track_catalog, 'artist_genres', ttl=60, max_size=10)
+    cache.set_many({f"artist{i}": ['genre'] for i in range(10)})
+    time.sleep(0.01)
+    cache.get_many(['artist0', 'artist1'])
+    time.sleep(0.01)
+    cache.set_many({f"new artist{i}": ['genre'] for i in range(3)})
+
+    assert track_catalog.count('artist_genres') == 9
+    assert cache.stats['evictions'] == 4
+    assert set(cache.get_many(['artist0', 'artist1', 'artist2', 'new artist0'])) == {
+        'artist0', 'artist1', 'new artist0'
+    }
+
+
+def test_rewritten_entries_are_not_counted_twice(track_catalog):
+    cache = catalog.CatalogCache(track_catalog, 'audio_features', ttl=60, max_size=5)
+    cache.set_many({f"track{i}": {'energy': 0.5} for i in range(5)})
+    cache.set_many({f"track{i}": {'energy': 0.7} for i in range(5)})
+    assert cache.stats['evictions'] == 0
+    assert track_catalog.count('audio_features') == 5
+
+
+def test_catalogs_without_last_used_are_migrated(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite3')
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        "CREATE TABLE artists (artist_uri TEXT PRIMARY KEY, name TEXT, genres TEXT, genres_expires_at REAL, "
+        "updated_at REAL NOT NULL);"
+        "INSERT INTO artists VALUES ('old artist', 'Old Artist', '[\"genre\"]', 1e18, 0);"
+    )
+    connection.commit()
+    connection.close()
+
+    track_catalog = catalog.TrackCatalog(path, helpers.AUDIO_FEATURES)
+    cache = catalog.CatalogCache(track_catalog, 'artist_genres', ttl=60, max_size=1)
+    assert cache.get_many(['old artist']) == {'old artist': ['genre']}
+    cache.set_many({'new artist': ['genre']})
+    assert set(cache.get_many(['old artist', 'new artist'])) == {'new artist'}
+    track_catalog.close()
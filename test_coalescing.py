@@ -0,0 +1,111 @@
+import threading
+import time
+import coalescing
+import rate_limiter
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [---------------------------FAKE CLIENTS------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+class FakeSpotify:
+    '''
+    Stands in for a user's Spotipy object. Every batch it is asked to fetch is recorded, and fetching fails if
+    it is broken (e.g., the user's token was revoked).
+    '''
+
+    def __init__(self, priority=rate_limiter.INTERACTIVE, broken=False, delay=0):
+        self.priority = priority
+        self.broken = broken
+        self.delay = delay
+        self.batches = []
+
+
+
+
+def fetch(sp, ids):
+    sp.batches.append(list(ids))
+    time.sleep(sp.delay)
+    if sp.broken:
+        raise RuntimeError('token revoked')
+    return {key: key.upper() for key in ids}
+
+
+
+
+def run_in_thread(coalescer, ids, sp, results):
+    def lookup():
+        try:
+            results[id(sp)] = coalescer.get_many(ids, sp, fetch)
+        except Exception as error:
+            results[id(sp)] = error
+    thread = threading.Thread(target=lookup)
+    thread.start()
+    return thread
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------TESTS-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+def test_misses_are_sent_in_full_batches():
+    coalescer = coalescing.LookupCoalescer(batch_size=2, name='test')
+    sp = FakeSpotify()
+    stats = {}
+    assert coalescer.get_many(['a', 'b', 'c'], sp, fetch, stats=stats) == {'a': 'A', 'b': 'B', 'c': 'C'}
+    assert sp.batches == [['a', 'b'], ['c']]
+    assert stats == {'api_calls': 2, 'joined': 0}
+
+
+def test_failed_batch_is_retried_by_the_lookups_that_joined_it():
+    coalescer = coalescing.LookupCoalescer(batch_size=50, name='test', linger=0)
+    broken_sp = FakeSpotify(broken=True, delay=0.1)
+    working_sp = FakeSpotify()
+    results = {}
+
+    broken_thread = run_in_thread(coalescer, ['a', 'b'], broken_sp, results)
+    time.sleep(0.05)
+    working_thread = run_in_thread(coalescer, ['b'], working_sp, results)
+    broken_thread.join(5)
+    working_thread.join(5)
+
+    assert isinstance(results[id(broken_sp)], RuntimeError)
+    assert results[id(working_sp)] == {'b': 'B'}
+    assert working_sp.batches == [['b']]
+    assert coalescer._in_flight == {} and coalescer._waiters == {}
+
+
+def test_bulk_lookups_do_not_send_interactive_ids():
+    coalescer = coalescing.LookupCoalescer(batch_size=1, name='test', linger=0)
+    interactive_sp = FakeSpotify(delay=0.1)
+    bulk_sp = FakeSpotify(priority=rate_limiter.BULK)
+    results = {}
+
+    # While the user's lookup is sending "x", background work joins the "b" it has queued
+    interactive_thread = run_in_thread(coalescer, ['x', 'b'], interactive_sp, results)
+    time.sleep(0.03)
+    bulk_thread = run_in_thread(coalescer, ['b', 'c'], bulk_sp, results)
+    interactive_thread.join(5)
+    bulk_thread.join(5)
+
+    assert results[id(bulk_sp)] == {'b': 'B', 'c': 'C'}
+    assert interactive_sp.batches == [['x'], ['b']]
+    assert bulk_sp.batches == [['c']]
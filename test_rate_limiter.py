@@ -0,0 +1,50 @@
+import threading
+import time
+import rate_limiter
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------TESTS-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+def test_interactive_waiters_get_slots_before_bulk_waiters():
+    semaphore = rate_limiter.PrioritySemaphore(1)
+    semaphore.acquire()
+    order = []
+
+    def wait_for_slot(name, priority):
+        semaphore.acquire(priority)
+        order.append(name)
+        semaphore.release()
+
+    threads = [
+        threading.Thread(target=wait_for_slot, args=('bulk', rate_limiter.BULK)),
+        threading.Thread(target=wait_for_slot, args=('interactive', rate_limiter.INTERACTIVE))
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    semaphore.release()
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ['interactive', 'bulk']
+
+
+def test_calls_have_their_priority_without_a_rate_limit():
+    class FakeSpotify:
+        def artist(self, artist_id):
+            return rate_limiter.current_priority()
+
+    sp = rate_limiter.RateLimitedSpotify(FakeSpotify(), None, 'user', rate_limiter.BULK)
+    assert sp.artist('stub') == rate_limiter.BULK
+    assert rate_limiter.current_priority() == rate_limiter.INTERACTIVE
@@ -0,0 +1,203 @@
+import gc
+import http.server
+import json
+import threading
+import time
+import pytest
+from spotipy.exceptions import SpotifyException
+import metrics
+import rate_limiter
+import spotify_clients
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------LOCAL STUB SERVER-----------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+class StubSpotifyHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers every GET like the Spotify artist endpoint. The server's responses list is used up first, one
+    status per request, e.g., [429, 503] to rate limit, then fail, then answer normally. 429s ask for a retry
+    after the server's retry_after seconds.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.client_address[1]))
+            status = self.server.responses.pop(0) if self.server.responses else 200
+
+        body = json.dumps({'id': 'stub', 'genres': ['stub genre']} if status == 200 else {
+            'error': {'status': status, 'message': 'stub error'}
+        }).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', self.server.retry_after)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+
+class CountingScheduler:
+    '''
+    Stands in for the TokenBucketScheduler, letting every call through and counting them.
+    '''
+
+    def __init__(self):
+        self.acquired = []
+
+    def acquire(self, user_key, priority=rate_limiter.INTERACTIVE):
+        self.acquired.append((user_key, priority))
+        return 0.0
+
+
+
+
+@pytest.fixture
+def stub_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubSpotifyHandler)
+    server.requests = []
+    server.responses = []
+    server.retry_after = '0'
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+
+
+@pytest.fixture
+def client_pool(stub_server):
+    http_session = spotify_clients.create_http_session(max_retries=3, backoff=0, jitter=0)
+    pool = spotify_clients.SpotifyClientPool(
+        http_session=http_session, api_prefix=f"http://127.0.0.1:{stub_server.server_port}/v1/"
+    )
+    yield pool
+    pool.close()
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------TESTS-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+def test_requests_go_to_api_prefix(stub_server, client_pool):
+    artist = client_pool.get('user', 'token').artist('stub')
+    assert artist['genres'] == ['stub genre']
+    assert stub_server.requests[0][0] == '/v1/artists/stub'
+
+
+def test_rate_limited_and_server_errors_are_retried(stub_server, client_pool):
+    stub_server.responses = [429, 503, 429]
+    assert client_pool.get('user', 'token').artist('stub')['id'] == 'stub'
+    assert len(stub_server.requests) == 4
+
+
+def test_gives_up_after_max_retries(stub_server, client_pool):
+    stub_server.responses = [429] * 10
+    with pytest.raises(SpotifyException) as error:
+        client_pool.get('user', 'token').artist('stub')
+    assert error.value.http_status == 429
+    assert len(stub_server.requests) == 4
+
+
+def test_retry_after_is_capped(stub_server):
+    stub_server.responses = [429]
+    stub_server.retry_after = '3600'
+    http_session = spotify_clients.create_http_session(backoff=0, jitter=0, max_wait=0.1)
+    pool = spotify_clients.SpotifyClientPool(
+        http_session=http_session, api_prefix=f"http://127.0.0.1:{stub_server.server_port}/v1/"
+    )
+    start = time.perf_counter()
+    assert pool.get('user', 'token').artist('stub')['id'] == 'stub'
+    assert time.perf_counter() - start < 2
+    pool.close()
+
+
+def test_waiting_retry_frees_host_slot(stub_server):
+    stub_server.responses = [429]
+    stub_server.retry_after = '1'
+    http_session = spotify_clients.create_http_session(host_concurrency=1, backoff=0, jitter=0)
+    pool = spotify_clients.SpotifyClientPool(
+        http_session=http_session, api_prefix=f"http://127.0.0.1:{stub_server.server_port}/v1/"
+    )
+    retried = threading.Thread(target=lambda: pool.get('first user', 'token').artist('retried'))
+    retried.start()
+    time.sleep(0.3)
+
+    # Sent while the first request waits out its Retry-After, and answered before it is retried
+    pool.get('second user', 'token').artist('stub')
+    retried.join(5)
+    paths = [path for path, _ in stub_server.requests]
+    assert paths == ['/v1/artists/retried', '/v1/artists/stub', '/v1/artists/retried']
+    pool.close()
+
+
+def test_retries_wait_their_turn(stub_server, client_pool):
+    stub_server.responses = [429, 503]
+    scheduler = CountingScheduler()
+    sp = rate_limiter.RateLimitedSpotify(client_pool.get('user', 'token'), scheduler, 'user', rate_limiter.BULK)
+    sp.artist('stub')
+    assert scheduler.acquired == [('user', rate_limiter.BULK)] * 3
+
+
+def test_connection_is_reused_across_users(stub_server, client_pool):
+    client_pool.get('first user', 'token').artist('stub')
+    client_pool.get('second user', 'token').artist('stub')
+    assert len({port for _, port in stub_server.requests}) == 1
+
+
+def test_dropping_a_client_keeps_shared_connections_open(stub_server, client_pool):
+    client_pool.get('user', 'old token').artist('stub')
+
+    # A token refresh replaces the user's client, and a new login removes it
+    client_pool.get('user', 'new token')
+    client_pool.remove('user')
+    gc.collect()
+
+    client_pool.get('other user', 'token').artist('stub')
+    assert len({port for _, port in stub_server.requests}) == 1
+
+
+def test_retried_responses_are_counted(stub_server, client_pool):
+    metrics.enable()
+    metrics.registry.clear()
+    try:
+        stub_server.responses = [429, 503]
+        sp = metrics.InstrumentedSpotify(client_pool.get('user', 'token'))
+        sp.artist('stub')
+        counters = metrics.registry._counters
+    finally:
+        metrics.enable(False)
+
+    for status in ('429', '503', '200'):
+        assert counters[('spotify_http_responses_total', (('endpoint', 'artists'), ('status', status)))] == 1
+    assert counters[('spotify_api_calls_total', (('endpoint', 'artist'), ('status', '200')))] == 1
+    metrics.registry.clear()
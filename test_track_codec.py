@@ -0,0 +1,48 @@
+import helper_functions as helpers
+import track_codec
+from benchmark import make_track_list
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [-----------------------------TESTS-----------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+def test_track_keys_match_the_track_object_format():
+    track_object = helpers.create_catalog_track_object({
+        'track_id': 'id', 'track_uri': 'uri', 'artists': [], 'artist_uris': [], 'track_name': 'name',
+        'album_name': 'album', 'album_art': None
+    })
+    assert tuple(track_object) == track_codec.TRACK_KEYS
+
+
+def test_round_trip_is_exact():
+    track_list = make_track_list(50)
+    track_list[3]['acousticness'] = None
+    track_list[4]['album_art'] = None
+    del track_list[5]['album_art']
+    track_list[6]['extra'] = {'added': True}
+
+    unpacked = track_codec.unpack_track_list(track_codec.pack_track_list(track_list))
+    assert unpacked == track_list
+    assert 'album_art' not in unpacked[5]
+
+
+def test_packed_track_list_is_five_times_smaller():
+    track_list = make_track_list(500)
+    plain = track_codec.ENCODER.encode(track_list)
+    assert len(plain) >= 5 * len(track_codec.pack_track_list(track_list))
+
+
+def test_unpacked_track_lists_are_returned_as_is():
+    track_list = make_track_list(2)
+    assert track_codec.unpack_track_list(track_list) is track_list
+    assert track_codec.unpack_track_list(None) == None
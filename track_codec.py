@@ -0,0 +1,117 @@
+import zlib
+from itertools import repeat
+from operator import itemgetter
+import msgspec
+
+
+
+
+
+
+# [---------------------------------------------------------------]
+# [--------------------------TRACK CODEC--------------------------]
+# [---------------------------------------------------------------]
+
+
+
+
+
+
+# Format version written at the start of each packed track_list, so the layout can change without breaking old
+# sessions
+CODEC_VERSION = 2
+
+# Keys of a track object (see helpers.create_catalog_track_object), in the order each track's values are stored.
+# Tracks with other keys are stored whole
+TRACK_KEYS = (
+    'track_id',
+    'track_uri',
+    'artists',
+    'artist_uris',
+    'track_name',
+    'album_name',
+    'album_art',
+    'genres',
+    'acousticness',
+    'danceability',
+    'energy',
+    'instrumentalness',
+    'liveness',
+    'speechiness',
+    'valence',
+    'score',
+    'missing_audio_features'
+)
+TRACK_KEY_SET = set(TRACK_KEYS)
+
+# zlib level used to compress packed track lists. Compression is most of the cost of packing and level 1 is
+# several times faster than the default level 6, for session files only about 10% larger
+COMPRESSION_LEVEL = 1
+
+# msgspec comes with flask_session, which uses the same MessagePack format for the whole session
+ENCODER = msgspec.msgpack.Encoder()
+DECODER = msgspec.msgpack.Decoder()
+
+get_track_values = itemgetter(*TRACK_KEYS)
+
+
+
+
+def pack_track_list(track_list):
+    '''
+    Packs track_list into compressed bytes for storing in the Flask session. Each track is stored as a row of
+    its values in TRACK_KEYS order, so the keys aren't repeated for every track, and the rows are encoded with
+    MessagePack and compressed. flask_session encodes and decodes the whole session on every request, so a
+    packed track_list is only copied as bytes on the requests that don't use it.
+
+    Args:
+        track_list: The track_list object from the Flask session.
+
+    Returns:
+        The packed track_list as bytes.
+    '''
+
+    # Tracks that don't have exactly the track object keys (e.g., no album_art, or extra keys) are stored
+    # whole, with an empty row in their place
+    other_tracks = {
+        position: track for position, track in enumerate(track_list) if track.keys() != TRACK_KEY_SET
+    }
+    if other_tracks:
+        rows = [
+            () if position in other_tracks else get_track_values(track)
+            for position, track in enumerate(track_list)
+        ]
+    else:
+        rows = list(map(get_track_values, track_list))
+
+    encoded = ENCODER.encode([rows, other_tracks])
+    return bytes([CODEC_VERSION]) + zlib.compress(encoded, COMPRESSION_LEVEL)
+
+
+
+
+def unpack_track_list(data):
+    '''
+    Unpacks a track_list packed by pack_track_list back into a list of track objects equal to the ones that
+    were packed. A track_list that was never packed (e.g., from a session saved before packing was added) or
+    None is returned as-is.
+
+    Args:
+        data: The packed track_list from the Flask session.
+
+    Returns:
+        The track_list, as a list of track objects.
+    '''
+
+    if not isinstance(data, bytes):
+        return data
+
+    if data[0] != CODEC_VERSION:
+        raise ValueError(f"Unsupported track_list format version {data[0]}")
+    rows, other_tracks = DECODER.decode(zlib.decompress(data[1:]))
+
+    track_list = list(map(dict, map(zip, repeat(TRACK_KEYS), rows)))
+    for position, track in other_tracks.items():
+        track_list[position] = track
+
+    return track_list